@@ -29,6 +29,24 @@
 
 import bpy, os, sys, argparse
 
+# The stk_utils module of the SuperTuxKart exporter addon, None if it is not
+# enabled
+def getSTKUtils():
+    cls = bpy.types.Operator.bl_rna_get_subclass_py("SCREEN_OT_stk_kart_export")
+    if cls is None:
+        return None
+    return sys.modules[cls.__module__].stk_utils
+
+# Export all objects of the scene as one SPM model, without going through the
+# export operator. A directory as save_path gets a file named after the blend
+# file.
+def exportSceneSPM(stk_utils, blend_file, save_path):
+    if os.path.isdir(save_path):
+        save_path = os.path.join(save_path, os.path.splitext(os.path.basename(blend_file))[0] + ".spm")
+    spm_parameters = {"export-tangent": 'precalculate_tangents' in bpy.context.scene and \
+                                        bpy.context.scene['precalculate_tangents'] == 'true'}
+    stk_utils.exportSPM(bpy.context.scene.objects, save_path, spm_parameters)
+
 def main():
     # get the args passed to blender after "--", all of which are ignored by
     # blender so scripts may receive their own arguments
@@ -79,16 +97,18 @@ def main():
 
     args = parser.parse_args(argv)
 
-    if 'spm_export' not in dir(bpy.ops.screen):
-        print("Error: Cannot find the SPM exporter. Make sure it is installed properly and enabled.")
-        return
-
-    if 'stk_material_export' not in dir(bpy.ops.screen) and \
+    stk_utils = getSTKUtils()
+    if stk_utils is None or \
+       'stk_material_export' not in dir(bpy.ops.screen) and \
        'stk_kart_export' not in dir(bpy.ops.screen) and \
        'stk_track_export' not in dir(bpy.ops.screen):
         print("Error: Cannot find the SuperTuxKart exporters. Make sure they are installed properly and enabled.")
         return
 
+    if stk_utils.getSPMExporter() is None:
+        print("Error: Cannot find the SPM exporter. Make sure it is installed properly and enabled.")
+        return
+
     # Use the current working directory for object export if not specified
     if not args.save_path:
         args.save_path = os.getcwd()
@@ -117,13 +137,9 @@ def main():
                 bpy.ops.screen.stk_track_export(filepath=args.save_path, exportScene=True, exportDrivelines=True, exportMaterials=True)
         except:
             print("Warning: File " + args.file + " does not contain a SuperTuxKart object, exporting as an SPM model")
-            bpy.ops.screen.spm_export(localsp=False, filepath=args.save_path, selected=False, \
-                                  export_tangent='precalculate_tangents' in bpy.context.scene\
-                                  and bpy.context.scene['precalculate_tangents'] == 'true')
+            exportSceneSPM(stk_utils, args.file, args.save_path)
     elif args.spm and not args.kart and not args.track and not args.materials:
-        bpy.ops.screen.spm_export(localsp=False, filepath=args.save_path, selected=False, \
-                                  export_tangent='precalculate_tangents' in bpy.context.scene\
-                                  and bpy.context.scene['precalculate_tangents'] == 'true')
+        exportSceneSPM(stk_utils, args.file, args.save_path)
     elif args.kart and not args.track and not args.materials and not args.spm:
         bpy.ops.screen.stk_kart_export(filepath=args.save_path)
     elif args.track and not args.kart and not args.materials and not args.spm:
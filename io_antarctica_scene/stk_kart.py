@@ -104,11 +104,9 @@ def saveHeadlights(self, f, lHeadlights, path, straight_frame):
             else:
                 instancing_objects[obj.data.name] = obj.name
 
-                obj.select_set(True)
-                bpy.ops.screen.spm_export(localsp=True, filepath=path + "/" + exported_name, selection_type="selected", \
-                                          export_tangent='precalculate_tangents' in bpy.context.scene\
-                                          and bpy.context.scene['precalculate_tangents'] == 'true')
-                obj.select_set(False)
+                stk_utils.exportSPM([obj], path + "/" + exported_name, {"local-space": True,
+                                    "export-tangent": 'precalculate_tangents' in bpy.context.scene\
+                                    and bpy.context.scene['precalculate_tangents'] == 'true'})
             flags.append('           model="%s"\n' % exported_name)
         f.write('%s' % ' '.join(flags) + '    />\n')
     f.write('  </headlights>\n')
@@ -159,11 +157,9 @@ def saveSpeedWeighted(self, f, lSpeedWeighted, path, straight_frame):
         else:
             instancing_objects[obj.data.name] = obj.name
 
-            obj.select_set(True)
-            bpy.ops.screen.spm_export(localsp=True, filepath=path + "/" + exported_name, selection_type="selected", \
-                                      export_tangent='precalculate_tangents' in bpy.context.scene\
-                                      and bpy.context.scene['precalculate_tangents'] == 'true')
-            obj.select_set(False)
+            stk_utils.exportSPM([obj], path + "/" + exported_name, {"local-space": True,
+                                "export-tangent": 'precalculate_tangents' in bpy.context.scene\
+                                and bpy.context.scene['precalculate_tangents'] == 'true'})
 
         flags.append('           model="%s"/>\n' % exported_name)
         f.write('%s' % ' '.join(flags))
@@ -200,11 +196,9 @@ def saveWheels(self, f, lWheels, path):
         lOldPos = Vector([wheel.location.x, wheel.location.y, wheel.location.z])
         wheel.location = Vector([0, 0, 0])
 
-        wheel.select_set(True)
-        bpy.ops.screen.spm_export(localsp=False, filepath=path + "/" + lWheelNames[index], selection_type="selected", \
-                                  export_tangent='precalculate_tangents' in bpy.context.scene\
-                                  and bpy.context.scene['precalculate_tangents'] == 'true')
-        wheel.select_set(False)
+        stk_utils.exportSPM([wheel], path + "/" + lWheelNames[index], {
+                            "export-tangent": 'precalculate_tangents' in bpy.context.scene\
+                            and bpy.context.scene['precalculate_tangents'] == 'true'})
 
         wheel.location = lOldPos
 
@@ -563,7 +557,6 @@ def exportKart(self, path):
 
         saveSounds(f, kart_engine_sfx, skid_sound)
         straight_frame = saveAnimations(self, f, kart_version, export_version)
-        bpy.ops.object.select_all(action='DESELECT')
         saveWheels(self, f, lWheels, path)
         saveSpeedWeighted(self, f, lSpeedWeighted, path, straight_frame)
         saveNitroEmitter(self, f, lNitroEmitter, path)
@@ -598,12 +591,10 @@ def exportKart(self, path):
 
         f.write('</kart>\n')
 
-    stk_utils.selectObjectsInList(lKart)
-    bpy.ops.screen.spm_export(localsp=False, filepath=path+"/"+model_file, selection_type="selected", \
-                              export_tangent='precalculate_tangents' in bpy.context.scene\
-                              and bpy.context.scene['precalculate_tangents'] == 'true', \
-                              static_mesh_frame = straight_frame)
-    bpy.ops.object.select_all(action='DESELECT')
+    stk_utils.exportSPM(lKart, path+"/"+model_file, {
+                        "export-tangent": 'precalculate_tangents' in bpy.context.scene\
+                        and bpy.context.scene['precalculate_tangents'] == 'true',
+                        "static-mesh-frame": straight_frame})
     stk_utils.hideTransientObjects();
 
     # materials file
@@ -615,7 +606,7 @@ def exportKart(self, path):
 
 # ==============================================================================
 def savescene_callback(self, context, sPath):
-    if 'spm_export' not in dir(bpy.ops.screen):
+    if stk_utils.getSPMExporter() is None:
         self.report({'ERROR'}, "Cannot find the spm exporter, make sure you installed it properly")
         return
 
@@ -504,6 +504,12 @@ class StkPanelAddonPreferences(bpy.types.AddonPreferences):
             default = False
             )
 
+    stk_link_images: bpy.props.BoolProperty(
+            name="Hard link texture files instead of copying them when possible",
+            description="Only works if the export folder is on the same drive, editing the exported texture then also edits the original",
+            default = False
+            )
+
     stk_check_tex_analyse: bpy.props.BoolProperty(
         name="Analyse Folder Texture",
         description="enable texture folder analysis",
@@ -523,6 +529,7 @@ class StkPanelAddonPreferences(bpy.types.AddonPreferences):
         layout.prop(self, "stk_tex_analyse")
         layout.prop(self, "stk_delete_old_files_on_export")
         layout.prop(self, "stk_export_images")
+        layout.prop(self, "stk_link_images")
         layout.prop(self, "stk_check_tex_analyse")
 
 class STK_FolderPicker_Operator(bpy.types.Operator):
@@ -193,18 +193,36 @@ class TrackExport:
 
         name = name + ".spm"
         # If the object was already exported, we don't have to do it again.
-        if name in self.dExportedObjects: return name
+        if name in self.dExportedObjects: return self.dExportedObjects[name]
 
-        obj.select_set(True)
+        spm_parameters = {"local-space": True,
+                          "export-tangent": stk_utils.getSceneProperty(bpy.context.scene, 'precalculate_tangents', 'false') == 'true',
+                          "apply-modifiers": applymodifiers}
+        # Objects with the same local geometry and materials as an already
+        # exported object use its model instead of a copy
         try:
-            bpy.ops.screen.spm_export(localsp=True, filepath=sPath+"/"+name, selection_type="selected", \
-                                      export_tangent=stk_utils.getSceneProperty(bpy.context.scene, 'precalculate_tangents', 'false') == 'true',
-                                      applymodifiers=applymodifiers)
-        except:
+            fingerprint = stk_utils.getSPMExporter().hashObjects([obj], spm_parameters)
+        except Exception:
+            fingerprint = None
+        if fingerprint is not None and fingerprint in self.dExportedFingerprints:
+            shared_name = self.dExportedFingerprints[fingerprint]
+            self.dExportedObjects[name] = shared_name
+            self.iDuplicateModels += 1
+            shared_file = sPath+"/"+shared_name
+            if os.path.exists(shared_file):
+                self.iDuplicateBytes += os.path.getsize(shared_file)
+            return shared_name
+
+        try:
+            stk_utils.exportSPM([obj], sPath+"/"+name, spm_parameters, self.export_cache, fingerprint)
+        except Exception:
             self.log.report({'ERROR'}, "Failed to export " + name)
-        obj.select_set(False)
+        else:
+            # Only successfully exported models can be shared
+            if fingerprint is not None:
+                self.dExportedFingerprints[fingerprint] = name
 
-        self.dExportedObjects[name]=1
+        self.dExportedObjects[name] = name
 
         return name
 
@@ -520,6 +538,11 @@ class TrackExport:
 
     # --------------------------------------------------------------------------
 
+    def writeInstancingModel(self, f, sPath, instancing_name, obj):
+        f.write("    <static-object lod_group=\"%s\" model=\"%s.spm\" %s interaction=\"%s\" skeletal-animation=\"false\"/>\n" % (instancing_name, instancing_name, stk_utils.getXYZHPRString(obj), stk_utils.getObjectProperty(obj, "interaction", "static")) )
+
+    # --------------------------------------------------------------------------
+
     def writeLODModels(self, f, sPath, lLODModels):
         for props in lLODModels:
             obj = props['object']
@@ -618,11 +641,8 @@ class TrackExport:
         type = stk_utils.getObjectProperty(obj, "type", "object")
         if type == "lod_model":
             pass
-        #elif type == "object" and stk_utils.getObjectProperty(obj, "instancing", "false") == "true":
-        #    group = type = stk_utils.getObjectProperty(obj, "name", "")
-        #    if len(group) == 0:
-        #        self.log.report({'WARNING'}, "Instancing object " + obj.name + " has no name property")
-        #    lodstring = ' instancing="true" instancing_model="' + group + '"'
+        elif type == "object" and obj.name in self.dInstancingGroups:
+            lodstring = ' instancing="true" instancing_model="' + self.dInstancingGroups[obj.name] + '"'
         elif type == "lod_instance":
             group = type = stk_utils.getObjectProperty(obj, "lod_name", "")
             if len(group) == 0:
@@ -825,9 +845,33 @@ class TrackExport:
             lStaticObjects = []
             # Include LOD models (i.e. the definition of a LOD group. Does not include LOD instances)
             lLODModels = {}
-            #lInstancingModels = {}
+            # Objects drawn as instances of one model (one object per instancing group)
+            lInstancingModels = {}
             lOtherObjects  = []
 
+            # Objects marked as instancing, and with automatic instancing objects
+            # sharing their mesh data, are grouped by the model they are exported to
+            auto_instancing = stk_utils.getSceneProperty(bpy.data.scenes[0], 'auto_instancing', 'false') == 'true'
+            dMeshUsers = {}
+            for obj in lObjects:
+                if obj.type == "MESH" and stk_utils.getObjectProperty(obj, "type", "??") == "object":
+                    dMeshUsers[obj.data.name] = dMeshUsers.get(obj.data.name, 0) + 1
+            for obj in lObjects:
+                if obj.type != "MESH" or stk_utils.getObjectProperty(obj, "type", "??") != "object":
+                    continue
+                if stk_utils.getObjectProperty(obj, "instancing", "false") != "true" and \
+                   not (auto_instancing and dMeshUsers[obj.data.name] > 1):
+                    continue
+                if obj.animation_data and obj.animation_data.action:
+                    self.log.report({'WARNING'}, 'Object %s is animated and cannot be instanced' % obj.name)
+                    continue
+                instancing_name = stk_utils.getObjectProperty(obj, "name", obj.name)
+                if len(instancing_name) == 0: instancing_name = obj.name
+                instancing_name = self.exportLocalSPM(obj, sPath, instancing_name, True)[:-len(".spm")]
+                if instancing_name not in lInstancingModels:
+                    lInstancingModels[instancing_name] = obj
+                self.dInstancingGroups[obj.name] = instancing_name
+
             for obj in lObjects:
                 type = stk_utils.getObjectProperty(obj, "type", "??")
                 interact = stk_utils.getObjectProperty(obj, "interaction", "static")
@@ -858,17 +902,6 @@ class TrackExport:
                 elif len(stk_utils.getObjectProperty(obj, "if", "")):
                     export_non_static = True
 
-                #if type == "object" and stk_utils.getObjectProperty(obj, "instancing", "false") == "true":
-                #    if is_lib_node:
-                #        instancing_name = stk_utils.getObjectProperty(obj, 'name', '')
-                #        if len(instancing_name) == 0:
-                #            self.log.report({'WARNING'}, 'Object %s marked as instancing has no name' % obj.name)
-                #            continue
-                #        lInstancingModels[instancing_name] = obj
-                #        lOtherObjects.append(obj)
-                #    else:
-                #        self.log.report({'WARNING'}, 'Object %s marked as instancing. Instancing only works with library nodes.' % obj.name)
-                #elif
                 if type == 'lod_model':
                     group_name = stk_utils.getObjectProperty(obj, 'lod_name', '')
                     if len(group_name) == 0:
@@ -932,13 +965,13 @@ class TrackExport:
                     f.write('   </group>\n')
                 f.write('  </lod>\n')
 
-            #if len(lInstancingModels.keys()) > 0:
-            #    f.write('  <instancing>\n')
-            #    for instancing_name in lInstancingModels.keys():
-            #        f.write('   <group name="%s">\n' % instancing_name)
-            #        self.writeInstancingModel(f, sPath, instancing_name, lInstancingModels[instancing_name])
-            #        f.write('   </group>\n')
-            #    f.write('  </instancing>\n')
+            if len(lInstancingModels.keys()) > 0:
+                f.write('  <instancing>\n')
+                for instancing_name in lInstancingModels.keys():
+                    f.write('   <group name="%s">\n' % instancing_name)
+                    self.writeInstancingModel(f, sPath, instancing_name, lInstancingModels[instancing_name])
+                    f.write('   </group>\n')
+                f.write('  </instancing>\n')
 
             if stk_utils.getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') != 'true':
                 if lStaticObjects or lAnimTextures:
@@ -1050,6 +1083,7 @@ class TrackExport:
                     if len(s) > 0: sphericalHarmonicsTextures.append(s)
                     if len(sphericalHarmonicsTextures) == 6:
                         sphericalHarmonicsStr = 'sh-texture="' + " ".join(sphericalHarmonicsTextures) + '"'
+                        stk_track_utils.writeSphericalHarmonics(sPath, sphericalHarmonicsTextures, self.log)
                     else:
                         self.log.report({'WARNING'}, 'Invalid ambient map textures')
 
@@ -1084,10 +1118,16 @@ class TrackExport:
 
     def __init__(self, log, sFilePath, exportImages, exportDrivelines, exportScene, exportMaterials):
         self.dExportedObjects = {}
+        self.dExportedFingerprints = {}
+        self.dInstancingGroups = {}
+        self.iDuplicateModels = 0
+        self.iDuplicateBytes = 0
         self.log = log
 
         sBase = os.path.basename(sFilePath)
         sPath = os.path.dirname(sFilePath)
+        # SPM files unchanged since the previous export are not written again
+        self.export_cache = stk_utils.getSPMExporter().ExportCache(sPath)
 
         stk_delete_old_files_on_export = False
         # check properties preference
@@ -1243,11 +1283,12 @@ class TrackExport:
         sTrackName = sBase+"_track.spm"
 
         stk_utils.unhideObjectsTransiently();
-        stk_utils.selectObjectsInList(lTrack)
         if exportScene and stk_utils.getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') != 'true':
-            bpy.ops.screen.spm_export(localsp=False, filepath=sPath+"/"+sTrackName, selection_type="selected", \
-                                      export_tangent=stk_utils.getSceneProperty(scene, 'precalculate_tangents', 'false') == 'true')
-        bpy.ops.object.select_all(action='DESELECT')
+            stk_utils.exportSPM(lTrack, sPath+"/"+sTrackName, {
+                                "export-tangent": stk_utils.getSceneProperty(scene, 'precalculate_tangents', 'false') == 'true',
+                                "sector-size": float(stk_utils.getSceneProperty(scene, 'sector_size', 0.0)),
+                                "optimize-vertex-cache": stk_utils.getSceneProperty(scene, 'optimize_vertex_cache', 'false') == 'true'},
+                                self.export_cache)
         stk_utils.hideTransientObjects();
 
         # scene file
@@ -1257,6 +1298,10 @@ class TrackExport:
 
             if len(lEasterEggs) > 0 and stk_utils.getSceneProperty(scene, 'is_stk_node', 'false') != 'true':
                 self.writeEasterEggsFile(sPath, lEasterEggs)
+        self.export_cache.save()
+        if self.iDuplicateModels > 0:
+            self.log.report({'INFO'}, "Reused identical models for %d objects, saving as many model loads and %.1f KiB"
+                            % (self.iDuplicateModels, self.iDuplicateBytes / 1024.0))
 
         # materials file
         # ----------
@@ -1270,7 +1315,7 @@ class TrackExport:
 
 # ==============================================================================
 def savescene_callback(self, sFilePath, exportImages, exportDrivelines, exportScene, exportMaterials):
-    if 'spm_export' not in dir(bpy.ops.screen):
+    if stk_utils.getSPMExporter() is None:
         self.report({'ERROR'}, "Cannot find the spm exporter, make sure you installed it properly")
         return
 
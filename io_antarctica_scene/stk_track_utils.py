@@ -20,8 +20,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import bpy, math, re, random
+import bpy, hashlib, math, os, re, struct, zlib
+import numpy as np
 from mathutils import *
+from mathutils import kdtree
 from . import stk_track, stk_utils
 
 # --------------------------------------------------------------------------
@@ -194,53 +196,224 @@ class BlenderHairExporter:
 
         return False # always return false so that the object is exported normally as a mesh too
 
+    # XML element around the location/rotation/scale string of an instance of
+    # instance_obj, for the library node it comes from or its exported model
+    def getInstanceElement(self, obj, instance_obj):
+        if instance_obj.library is not None or instance_obj.override_library is not None:
+            if obj.library is not None:
+                #path_parts = re.split("/|\\\\", obj.library.filepath)
+                path_parts = re.split("/|\\\\", instance_obj.library.filepath)
+            else:
+                #path_parts = re.split("/|\\\\", obj.override_library.reference.library.filepath)
+                path_parts = re.split("/|\\\\", instance_obj.override_library.reference.library.filepath)
+            return ('  <library name="%s" id="%s" ' % (path_parts[-2], instance_obj.name), '/>\n')
+        name = stk_utils.getObjectProperty(instance_obj, "name", instance_obj.name)
+        if len(name) == 0:
+            name = instance_obj.name
+        return ('  <object type="animation" ',
+                ' interaction="ghost" model="%s.spm" skeletal-animation="false"></object>\n' % name)
+
     def export(self, f):
         rad2deg = 180.0/3.1415926535;
 
         for obj in self.m_objects:
 
             for particleSystem in obj.particle_systems:
+                particles = particleSystem.particles
+                count = len(particles)
+                f.write('  <!-- Hair system %s, contains %i particles -->\n' % (obj.name, count))
+                if count == 0:
+                    continue
 
-                f.write('  <!-- Hair system %s, contains %i particles -->\n' % (obj.name, len(particleSystem.particles)))
-
-                for particle in particleSystem.particles:
-                    if particleSystem.settings.render_type == 'OBJECT':
-                        instance_obj = particleSystem.settings.instance_object
-                    # Currently we only support random picking from the group
-                    elif particleSystem.settings.render_type == 'COLLECTION':
-                        object_group = particleSystem.settings.instance_collection.objects
-                        choice = random.randint(0, len(object_group) - 1)
-                        instance_obj = object_group[choice]
-
-                    loc = particle.location
-                    hpr = particle.rotation.to_euler('XYZ')
-
-                    # hack to get proper orientation
-                    if (particleSystem.settings.normal_factor >= 0.5):
-                        hpr.rotate_axis("Z", -1.57079633)
-
-                    #print (particle.size)
-                    si = particle.size #/ instance_obj.dimensions[2]
-                    loc_rot_scale_str = "xyz=\"%.2f %.2f %.2f\" hpr=\"%.1f %.1f %.1f\" scale=\"%.2f %.2f %.2f\"" %\
-                       (loc[0], loc[2], loc[1], -hpr[0]*rad2deg, -hpr[2]*rad2deg,
-                        -hpr[1]*rad2deg, si, si, si)
-
-                    if instance_obj.library is not None or instance_obj.override_library is not None:
-                        if obj.library is not None:
-                            #path_parts = re.split("/|\\\\", obj.library.filepath)
-                            path_parts = re.split("/|\\\\", instance_obj.library.filepath)
-                        else:
-                            #path_parts = re.split("/|\\\\", obj.override_library.reference.library.filepath)
-                            path_parts = re.split("/|\\\\", instance_obj.override_library.reference.library.filepath)
-                        f.write('  <library name="%s" id=\"%s\" %s/>\n' % (path_parts[-2], instance_obj.name, loc_rot_scale_str))
-                    else:
-                        name = stk_utils.getObjectProperty(instance_obj, "name", instance_obj.name)
-                        if len(name) == 0:
-                            name = instance_obj.name
-                        f.write('  <object type="animation" %s interaction="ghost" model="%s.spm" skeletal-animation="false"></object>\n' % (loc_rot_scale_str, name))
+                location = np.empty(count * 3, dtype=np.float32)
+                particles.foreach_get("location", location)
+                location = location.reshape(-1, 3)
+                rotation = np.empty(count * 4, dtype=np.float32)
+                particles.foreach_get("rotation", rotation)
+                size = np.empty(count, dtype=np.float32)
+                particles.foreach_get("size", size)
+
+                # hack to get proper orientation
+                hpr = quaternionsToEulers(rotation.reshape(-1, 4),
+                                          -1.57079633 if particleSystem.settings.normal_factor >= 0.5 else 0.0)
+                hpr *= -rad2deg
+
+                if particleSystem.settings.render_type == 'OBJECT':
+                    instance_objects = [particleSystem.settings.instance_object]
+                    choice = np.zeros(count, dtype=np.int64)
+                # Currently we only support random picking from the group,
+                # seeded by the particle system so that exports are reproducible
+                elif particleSystem.settings.render_type == 'COLLECTION':
+                    instance_objects = list(particleSystem.settings.instance_collection.objects)
+                    choice = np.random.default_rng(particleSystem.seed).integers(0, len(instance_objects), count)
+                else:
+                    instance_objects = []
+                    choice = np.zeros(count, dtype=np.int64)
+
+                if len(instance_objects) == 0:
+                    continue
+
+                # One element per particle, in particle order as before
+                values = np.column_stack((location[:, [0, 2, 1]], hpr[:, [0, 2, 1]], size, size, size)).tolist()
+                lElements = []
+                for instance_obj in instance_objects:
+                    prefix, suffix = self.getInstanceElement(obj, instance_obj)
+                    lElements.append(prefix + 'xyz="%.2f %.2f %.2f" hpr="%.1f %.1f %.1f" scale="%.2f %.2f %.2f"' + suffix)
+                f.write(''.join([lElements[instance_id] % tuple(value)
+                                 for instance_id, value in zip(choice.tolist(), values)]))
 
             f.write('  <!-- END Hair system %s -->\n\n' % obj.name)
 
+# Blender Quaternion.to_euler('XYZ') of an array of (w, x, y, z) rotations,
+# rotated by z_angle around the local Z axis first like Euler.rotate_axis("Z")
+def quaternionsToEulers(quaternions, z_angle):
+    quaternions = quaternions.astype(np.float64)
+    norm = np.linalg.norm(quaternions, axis=1)
+    quaternions /= np.where(norm > 0.0, norm, 1.0)[:, None]
+    w, x, y, z = quaternions.T
+    matrix = np.empty((len(quaternions), 3, 3))
+    matrix[:, 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    matrix[:, 0, 1] = 2.0 * (x * y - w * z)
+    matrix[:, 0, 2] = 2.0 * (x * z + w * y)
+    matrix[:, 1, 0] = 2.0 * (x * y + w * z)
+    matrix[:, 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    matrix[:, 1, 2] = 2.0 * (y * z - w * x)
+    matrix[:, 2, 0] = 2.0 * (x * z - w * y)
+    matrix[:, 2, 1] = 2.0 * (y * z + w * x)
+    matrix[:, 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+    if z_angle != 0.0:
+        cos_z = math.cos(z_angle)
+        sin_z = math.sin(z_angle)
+        matrix = matrix @ np.array([[cos_z, -sin_z, 0.0], [sin_z, cos_z, 0.0], [0.0, 0.0, 1.0]])
+
+    # Of the two possible solutions, the one with the smallest rotations is
+    # used, like mathutils does
+    cy = np.hypot(matrix[:, 0, 0], matrix[:, 1, 0])
+    euler1 = np.column_stack((np.arctan2(matrix[:, 2, 1], matrix[:, 2, 2]),
+                              np.arctan2(-matrix[:, 2, 0], cy),
+                              np.arctan2(matrix[:, 1, 0], matrix[:, 0, 0])))
+    euler2 = np.column_stack((np.arctan2(-matrix[:, 2, 1], -matrix[:, 2, 2]),
+                              np.arctan2(-matrix[:, 2, 0], -cy),
+                              np.arctan2(-matrix[:, 1, 0], -matrix[:, 0, 0])))
+    gimbal_lock = cy <= 16.0 * np.finfo(np.float32).eps
+    euler1[gimbal_lock, 0] = np.arctan2(-matrix[gimbal_lock, 1, 2], matrix[gimbal_lock, 1, 1])
+    euler1[gimbal_lock, 2] = 0.0
+    euler2[gimbal_lock] = euler1[gimbal_lock]
+    use_second = np.abs(euler1).sum(axis=1) > np.abs(euler2).sum(axis=1)
+    euler1[use_second] = euler2[use_second]
+    return euler1
+
+# ------------------------------------------------------------------------------
+# Spherical harmonics of the ambient map: the six images of the cube map (in
+# the order of sh-texture: top, bottom, east, west, north, south) are
+# projected on the 9 real spherical harmonics of bands 0 to 2, in the order
+# Y00, Y1-1 (y), Y10 (z), Y11 (x), Y2-2 (xy), Y2-1 (yz), Y20, Y21 (xz), Y22,
+# using the same cube face layout as the game. Each texel is weighted by the
+# solid angle it covers.
+
+# Direction of the texel (u, v) (in -1..1, v going down in the image) of
+# each cube face, in the order of sh-texture
+lCubeFaceDirections = [lambda u, v: (u, np.ones_like(u), v),        # top
+                       lambda u, v: (u, -np.ones_like(u), -v),      # bottom
+                       lambda u, v: (np.ones_like(u), -v, -u),      # east
+                       lambda u, v: (-np.ones_like(u), -v, u),      # west
+                       lambda u, v: (-u, -v, -np.ones_like(u)),     # north
+                       lambda u, v: (u, -v, np.ones_like(u))]       # south
+
+# Returns the SH coefficients as a (3 x 9) array (red, green, blue) of a list
+# of six (rows x columns x 3) float images (top row first). Faces are
+# reduced to at most 128 texels on a side first, the low frequency bands do
+# not need more.
+def computeSphericalHarmonics(lFaces):
+    coefficients = np.zeros((3, 9))
+    total_weight = 0.0
+    for face, direction in zip(lFaces, lCubeFaceDirections):
+        factor = max(1, max(face.shape[0], face.shape[1]) // 128)
+        (height, width) = (face.shape[0] // factor, face.shape[1] // factor)
+        face = face[:height*factor, :width*factor, :3].reshape(height, factor, width, factor, 3).mean(axis=(1, 3))
+
+        v, u = np.meshgrid((np.arange(height) + 0.5) / height * 2.0 - 1.0,
+                           (np.arange(width) + 0.5) / width * 2.0 - 1.0, indexing="ij")
+        (x, y, z) = direction(u, v)
+        length_sq = u*u + v*v + 1.0
+        weight = (4.0 / (width * height)) / (length_sq * np.sqrt(length_sq))
+        (x, y, z) = (x / np.sqrt(length_sq), y / np.sqrt(length_sq), z / np.sqrt(length_sq))
+
+        basis = np.stack((np.full_like(x, 0.282095),
+                          0.488603 * y, 0.488603 * z, 0.488603 * x,
+                          1.092548 * x * y, 1.092548 * y * z,
+                          0.315392 * (3.0 * z * z - 1.0),
+                          1.092548 * x * z, 0.546274 * (x * x - y * y)))
+        coefficients += np.einsum("khw,hwc->ck", basis * weight, face)
+        total_weight += weight.sum()
+
+    # Normalize the sum of the solid angles to exactly 4 pi
+    return coefficients * (4.0 * math.pi / total_weight)
+
+# ------------------------------------------------------------------------------
+# Returns the path of a texture used by the track: the file of a loaded image
+# with that name, or the file in the track directory.
+def findTextureFile(sPath, sName):
+    for image in bpy.data.images:
+        if image.filepath:
+            sFile = bpy.path.abspath(image.filepath)
+            if os.path.basename(sFile) == sName and os.path.isfile(sFile):
+                return sFile
+    sFile = os.path.join(sPath, sName)
+    return sFile if os.path.isfile(sFile) else None
+
+# ------------------------------------------------------------------------------
+# Writes spherical_harmonics.xml with the SH coefficients of the ambient map
+# textures, so that they do not have to be computed when the track is loaded.
+# The file stores a hash of the content of the six images, and the
+# coefficients are only computed again if an image changed.
+def writeSphericalHarmonics(sPath, lTextures, log):
+    lFiles = [findTextureFile(sPath, sName) for sName in lTextures]
+    if None in lFiles:
+        log.report({'WARNING'}, "Ambient map texture '%s' not found, spherical harmonics not precomputed" % \
+                   lTextures[lFiles.index(None)])
+        return
+
+    content_hash = hashlib.blake2b(digest_size=16)
+    for sFile in lFiles:
+        with open(sFile, "rb") as f:
+            content_hash.update(f.read())
+    content_hash = content_hash.hexdigest()
+
+    sOutput = os.path.join(sPath, "spherical_harmonics.xml")
+    if os.path.isfile(sOutput):
+        with open(sOutput, "r", encoding="utf8") as f:
+            if ('hash="%s"' % content_hash) in f.read():
+                print("Spherical harmonics are up to date, skipping")
+                return
+
+    # Images loaded here only for reading their pixels are removed again,
+    # images already used by the blend file are kept
+    lExistingImages = set(bpy.data.images)
+    lFaces = []
+    try:
+        for sFile in lFiles:
+            image = bpy.data.images.load(sFile, check_existing=True)
+            (width, height) = image.size
+            pixels = np.empty(width * height * image.channels, dtype=np.float32)
+            image.pixels.foreach_get(pixels)
+            # Blender stores the bottom row first
+            pixels = pixels.reshape(height, width, image.channels)[::-1]
+            if image.channels < 3:
+                pixels = np.repeat(pixels[:, :, :1], 3, axis=2)
+            lFaces.append(pixels)
+    finally:
+        for image in [image for image in bpy.data.images if image not in lExistingImages]:
+            bpy.data.images.remove(image)
+
+    coefficients = computeSphericalHarmonics(lFaces)
+    with open(sOutput, "w", encoding="utf8", newline="\n") as f:
+        f.write("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n")
+        f.write("<spherical-harmonics textures=\"%s\" hash=\"%s\">\n" % (" ".join(lTextures), content_hash))
+        for sChannel, channel in zip(("red", "green", "blue"), coefficients):
+            f.write("  <%s coefficients=\"%s\"/>\n" % (sChannel, " ".join("%f" % c for c in channel)))
+        f.write("</spherical-harmonics>\n")
+
 
 # ------------------------------------------------------------------------------
 class SoundEmitterExporter:
@@ -624,63 +797,466 @@ class NavmeshExporter:
     def export(self, f):
         return None
 
+    # --------------------------------------------------------------------------
+    # Returns the unit normal of a polygon (a list of vertex indices).
+    def getPolygonNormal(self, vertices, polygon):
+        p = vertices[polygon]
+        normal = np.cross(p, np.roll(p, -1, axis=0)).sum(axis=0)
+        length = np.linalg.norm(normal)
+        return normal / length if length > 0 else normal
+
+    # --------------------------------------------------------------------------
+    # Merges two polygons sharing the edge u->v of polygon_a (v->u in
+    # polygon_b). The merged polygon starts at v and contains u at index
+    # len(polygon_a)-1. Returns None if the polygons are not oriented the same
+    # way.
+    def mergePolygons(self, polygon_a, polygon_b, u, v):
+        i = polygon_a.index(u)
+        j = polygon_b.index(u)
+        if polygon_a[(i+1) % len(polygon_a)] != v or polygon_b[j-1] != v:
+            return None
+        a = polygon_a[i+1:] + polygon_a[:i+1]
+        b = polygon_b[j:] + polygon_b[:j]
+        return a + b[1:-1]
+
+    # --------------------------------------------------------------------------
+    # Tests if two adjacent polygons can be replaced by merged (their merged
+    # polygon without the vertices in lDropped): both must be in the same
+    # plane (normals within the angle, all vertices within the height of the
+    # plane), the merged polygon must be convex and each dropped vertex must
+    # be on a straight line between its neighbours.
+    def isMergeValid(self, vertices, polygon_a, polygon_b, merged, lDropped,
+                     cos_angle, max_height):
+        if np.dot(self.getPolygonNormal(vertices, polygon_a),
+                  self.getPolygonNormal(vertices, polygon_b)) < cos_angle:
+            return False
+
+        lCorner = [i for i in merged if i not in lDropped]
+        normal = self.getPolygonNormal(vertices, lCorner)
+        p = vertices[merged]
+        if np.abs((p - p.mean(axis=0)) @ normal).max() > max_height:
+            return False
+
+        corners = vertices[lCorner]
+        side = np.roll(corners, -1, axis=0) - corners
+        turn = np.cross(side, np.roll(side, -1, axis=0)) @ normal
+        if not (turn > 1e-6 * np.einsum("ij,ij->i", side, side).max()).all():
+            return False
+
+        for i in [merged.index(d) for d in lDropped]:
+            before = vertices[merged[i]] - vertices[merged[i-1]]
+            after = vertices[merged[(i+1) % len(merged)]] - vertices[merged[i]]
+            length = np.linalg.norm(before) * np.linalg.norm(after)
+            if length == 0 or np.dot(before, after) < cos_angle * length:
+                return False
+        return True
+
+    # --------------------------------------------------------------------------
+    # Returns a dictionary edge -> list of polygons, an edge is the sorted
+    # tuple of its vertex indices.
+    def getEdgeFaces(self, lPolygons):
+        dEdgeFaces = {}
+        for f, polygon in enumerate(lPolygons):
+            for i in range(len(polygon)):
+                edge = tuple(sorted((polygon[i-1], polygon[i])))
+                dEdgeFaces.setdefault(edge, []).append(f)
+        return dEdgeFaces
+
+    # --------------------------------------------------------------------------
+    # Re-quads a (partially) triangulated navmesh: adjacent triangles that
+    # form a planar convex quad are merged, longest shared edge (usually the
+    # diagonal of the quad) first.
+    def pairNavmeshTriangles(self, vertices, lPolygons, lOrigin, cos_angle, max_height):
+        lCandidate = []
+        for edge, lFaces in self.getEdgeFaces(lPolygons).items():
+            if len(lFaces) == 2 and len(lPolygons[lFaces[0]]) == 3 and len(lPolygons[lFaces[1]]) == 3:
+                length = np.linalg.norm(vertices[edge[0]] - vertices[edge[1]])
+                lCandidate.append((-length, edge, lFaces))
+        lCandidate.sort()
+
+        dMerged = {}
+        lRemoved = set()
+        for (length, edge, (fa, fb)) in lCandidate:
+            if fa in dMerged or fb in dMerged or fa in lRemoved or fb in lRemoved:
+                continue
+            (u, v) = edge
+            if lPolygons[fa][(lPolygons[fa].index(u)+1) % 3] != v:
+                (u, v) = (v, u)
+            merged = self.mergePolygons(lPolygons[fa], lPolygons[fb], u, v)
+            if merged is None or not self.isMergeValid(vertices, lPolygons[fa], lPolygons[fb],
+                                                       merged, [], cos_angle, max_height):
+                continue
+            dMerged[fa] = merged
+            lRemoved.add(fb)
+
+        return ([dMerged.get(f, polygon) for f, polygon in enumerate(lPolygons) if f not in lRemoved],
+                [lOrigin[f] for f in range(len(lPolygons)) if f not in lRemoved])
+
+    # --------------------------------------------------------------------------
+    # Removes whole lines of edges between quads (like dissolving an edge
+    # loop): each edge of the line merges its two quads into one. A line
+    # can only go straight through vertices shared by exactly 4 quads and
+    # must end at the border of the navmesh (or be closed), so no vertex is
+    # removed from one quad while still being the corner of another one (which
+    # would break the adjacency). Returns the number of removed lines.
+    def dissolveNavmeshLines(self, vertices, lPolygons, lOrigin, cos_angle, max_height):
+        dEdgeFaces = self.getEdgeFaces(lPolygons)
+        dVertexFaces = {}
+        dVertexEdges = {}
+        for f, polygon in enumerate(lPolygons):
+            for i in polygon:
+                dVertexFaces.setdefault(i, []).append(f)
+        for edge in dEdgeFaces:
+            for i in edge:
+                dVertexEdges.setdefault(i, []).append(edge)
+
+        # Returns the edge continuing the line of edge at vertex i, None if
+        # the line ends at i, or False if the line cannot be removed.
+        def nextEdge(edge, i):
+            lFaces = dEdgeFaces[edge]
+            if len(dVertexFaces[i]) == 2 and len(dVertexEdges[i]) == 3:
+                return None
+            if len(dVertexFaces[i]) != 4 or len(dVertexEdges[i]) != 4:
+                return False
+            for next_edge in dVertexEdges[i]:
+                if next_edge != edge and not set(dEdgeFaces[next_edge]) & set(lFaces):
+                    return next_edge
+            return False
+
+        lUsed = set()
+        lChecked = set()
+        dMerged = {}
+        lRemoved = set()
+        lines = 0
+        for start_edge in sorted(dEdgeFaces):
+            if start_edge in lChecked:
+                continue
+
+            # Collect the line, walking in both directions from start_edge
+            lLine = [start_edge]
+            valid = True
+            for i in start_edge:
+                edge = start_edge
+                while valid:
+                    next_edge = nextEdge(edge, i)
+                    if next_edge is None or next_edge == start_edge:
+                        break
+                    if next_edge is False or next_edge in lLine:
+                        valid = False
+                        break
+                    lLine.append(next_edge)
+                    i = next_edge[0] if next_edge[1] == i else next_edge[1]
+                    edge = next_edge
+                if next_edge == start_edge:
+                    break
+            lChecked.update(lLine)
+            if not valid:
+                continue
+
+            lPairs = [dEdgeFaces[edge] for edge in lLine]
+            lFaces = [f for pair in lPairs for f in pair]
+            if any(len(pair) != 2 for pair in lPairs) or len(set(lFaces)) != len(lFaces) or \
+               any(len(lPolygons[f]) != 4 or f in lUsed for f in lFaces):
+                continue
+
+            dLine = {}
+            for (edge, (fa, fb)) in zip(lLine, lPairs):
+                (u, v) = edge
+                if lPolygons[fa][(lPolygons[fa].index(u)+1) % 4] != v:
+                    (u, v) = (v, u)
+                merged = self.mergePolygons(lPolygons[fa], lPolygons[fb], u, v)
+                if merged is None or not self.isMergeValid(vertices, lPolygons[fa], lPolygons[fb],
+                                                           merged, [u, v], cos_angle, max_height):
+                    break
+                dLine[fa] = [i for i in merged if i != u and i != v]
+                dLine[fb] = None
+            else:
+                lUsed.update(lFaces)
+                for f, polygon in dLine.items():
+                    if polygon is None:
+                        lRemoved.add(f)
+                    else:
+                        dMerged[f] = polygon
+                lines += 1
+
+        lPolygons[:] = [dMerged.get(f, polygon) for f, polygon in enumerate(lPolygons) if f not in lRemoved]
+        lOrigin[:] = [lOrigin[f] for f in range(len(lOrigin)) if f not in lRemoved]
+        return lines
+
+    # --------------------------------------------------------------------------
+    # Simplifies the navmesh: triangles are paired into quads, then lines of
+    # edges between coplanar quads are removed until nothing can be merged
+    # any more. lOrigin is the index of the original face of each polygon
+    # (for error messages). Returns the new lists of polygons and origins.
+    def simplifyNavmesh(self, vertices, lPolygons, lOrigin, max_angle, max_height):
+        cos_angle = math.cos(math.radians(max_angle))
+        (lPolygons, lOrigin) = self.pairNavmeshTriangles(vertices, lPolygons, lOrigin,
+                                                         cos_angle, max_height)
+        while self.dissolveNavmeshLines(vertices, lPolygons, lOrigin, cos_angle, max_height) > 0:
+            pass
+        return (lPolygons, lOrigin)
+
+    # --------------------------------------------------------------------------
+    # Reads the navmesh object into numpy arrays: the world space vertices
+    # (in STK coordinates, i.e. y and z swapped), the vertex indices of each
+    # face and the faces adjacent to each face (sharing an edge with it) in
+    # compressed form: the adjacents of face i are
+    # adjacents[offsets[i]:offsets[i+1]]. If requested on the navmesh object,
+    # the navmesh is simplified first (see simplifyNavmesh). Returns None if
+    # a face is not a quad.
+    def getNavmeshArrays(self, navmesh_obj):
+        mm = navmesh_obj.to_mesh()
+        co = np.empty(len(mm.vertices)*3, dtype=np.float32)
+        mm.vertices.foreach_get("co", co)
+        loop_start = np.empty(len(mm.polygons), dtype=np.int64)
+        mm.polygons.foreach_get("loop_start", loop_start)
+        loop_total = np.empty(len(mm.polygons), dtype=np.int64)
+        mm.polygons.foreach_get("loop_total", loop_total)
+        loop_vertex = np.empty(len(mm.loops), dtype=np.int64)
+        mm.loops.foreach_get("vertex_index", loop_vertex)
+        navmesh_obj.to_mesh_clear()
+
+        # All vertices are transformed at once
+        om = np.array(navmesh_obj.matrix_world, dtype=np.float64)
+        vertices = co.reshape(-1, 3) @ om[:3, :3].T + om[:3, 3]
+        vertices = vertices[:, [0, 2, 1]]
+
+        # Original index of each face (for error messages)
+        origin = np.arange(len(loop_total))
+        simplify = stk_utils.getObjectProperty(navmesh_obj, "simplify_navmesh", "false") == "true"
+        if simplify:
+            lPolygons = [loop_vertex[start:start+total].tolist()
+                         for (start, total) in zip(loop_start.tolist(), loop_total.tolist())]
+            (lPolygons, lOrigin) = self.simplifyNavmesh(vertices, lPolygons, origin.tolist(),
+                stk_utils.getObjectProperty(navmesh_obj, "simplify_angle", 5.0),
+                stk_utils.getObjectProperty(navmesh_obj, "simplify_height", 0.05))
+            self.log.report({'INFO'}, "Navmesh simplified from %d to %d faces" % (len(loop_total), len(lPolygons)))
+            loop_total = np.array([len(polygon) for polygon in lPolygons], dtype=np.int64)
+            origin = np.array(lOrigin, dtype=np.int64)
+
+        lNotQuad = np.flatnonzero(loop_total != 4)
+        if len(lNotQuad) > 0:
+            face_index = int(origin[lNotQuad[0]])
+            self.log.report({'ERROR'}, 'Use only quad for navmesh, face %d not quad!' % face_index)
+            self.log.report({'ERROR'}, 'To find it out, select the navmesh object and toggle edit mode, than in python console:')
+            self.log.report({'ERROR'}, 'me = bpy.data.objects[\'%s\'].data' % navmesh_obj.name)
+            self.log.report({'ERROR'}, 'import bmesh')
+            self.log.report({'ERROR'}, 'bm = bmesh.from_edit_mesh(me)')
+            self.log.report({'ERROR'}, 'bm.faces[%d].select = True' % face_index)
+            self.log.report({'ERROR'}, 'bmesh.update_edit_mesh(me, True)')
+            return None
+
+        n_faces = len(loop_total)
+        if simplify:
+            # Only keep the vertices still used by a face
+            faces = np.array(lPolygons, dtype=np.int64).reshape(-1, 4)
+            (lUsed, faces) = np.unique(faces, return_inverse=True)
+            faces = faces.reshape(-1, 4)
+            vertices = vertices[lUsed]
+        else:
+            face_loops = np.repeat(loop_start, 4) + np.tile(np.arange(4), n_faces)
+            faces = loop_vertex[face_loops].reshape(-1, 4)
+
+        # Edge index of every side of every face (position p belongs to face
+        # p // 4)
+        start = faces.ravel()
+        end = np.roll(faces, -1, axis=1).ravel()
+        edges = np.unique(np.minimum(start, end)*len(vertices) + np.maximum(start, end),
+                          return_inverse=True)[1].ravel()
+
+        # Sort the loops by edge, so the faces sharing an edge are next to
+        # each other, and pair every loop with the other faces of its edge.
+        by_edge = np.argsort(edges, kind="stable")
+        sorted_edges = edges[by_edge]
+        lPosition = []
+        lAdjacent = []
+        d = 1
+        while d < len(sorted_edges):
+            same = np.flatnonzero(sorted_edges[d:] == sorted_edges[:-d])
+            if len(same) == 0:
+                break
+            lPosition += [by_edge[same], by_edge[same + d]]
+            lAdjacent += [by_edge[same + d] // 4, by_edge[same] // 4]
+            d += 1
+
+        offsets = np.zeros(n_faces + 1, dtype=np.int64)
+        if len(lPosition) == 0:
+            return (vertices, faces, offsets, np.zeros(0, dtype=np.int64))
+
+        position = np.concatenate(lPosition)
+        adjacent = np.concatenate(lAdjacent)
+        owner = position // 4
+        keep = owner != adjacent
+        position, adjacent, owner = position[keep], adjacent[keep], owner[keep]
+
+        # Adjacent faces are listed in the order of the edges of the face,
+        # each face only once.
+        order = np.lexsort((adjacent, position))
+        adjacent, owner = adjacent[order], owner[order]
+        first = np.sort(np.unique(owner*n_faces + adjacent, return_index=True)[1])
+        adjacent, owner = adjacent[first], owner[first]
+        offsets[1:] = np.cumsum(np.bincount(owner, minlength=n_faces))
+        return (vertices, faces, offsets, adjacent)
+
+    # --------------------------------------------------------------------------
+    # Writes navmesh.xml and, if requested on the navmesh object, navmesh.bin:
+    # a compact little endian copy of the same data for large arenas. Its
+    # layout is: b'STKN', uint16 version, uint16 vertices per polygon (4),
+    # float32 min and max height testing, uint32 vertex, face and adjacent
+    # counts, float32 x y z per vertex, uint32 vertex indices per face,
+    # uint32 (face count + 1) offsets into the adjacents and the uint32
+    # adjacent face indices.
     def exportNavmesh(self, sPath):
         print("exportNavmesh 2")
-        import bmesh
         if len(self.m_objects) > 0:
             print("exportNavmesh 3")
+            navmesh_obj = self.m_objects[0]
+            navmesh = self.getNavmeshArrays(navmesh_obj)
+            assert navmesh is not None
+            (vertices, faces, offsets, adjacent) = navmesh
+
+            min_height_testing = stk_utils.getObjectProperty(navmesh_obj, "min_height_testing", -1.0)
+            max_height_testing = stk_utils.getObjectProperty(navmesh_obj, "max_height_testing", 5.0)
+
+            lLines = ['<?xml version="1.0" encoding=\"utf-8\"?>\n',
+                      '<navmesh>\n',
+                      '<height-testing min="%f" max="%f"/>\n' % (min_height_testing, max_height_testing),
+                      '<MaxVertsPerPoly nvp="4" />\n',
+                      '<vertices>\n']
+            lLines += ['<vertex x="%f" y="%f" z="%f" />\n' % tuple(v) for v in vertices.tolist()]
+            lLines.append('</vertices>\n')
+            lLines.append('<faces>\n')
+            lOffsets = offsets.tolist()
+            lAdjacent = adjacent.tolist()
+            for i, face in enumerate(faces.tolist()):
+                lLines.append('<face indices="%d %d %d %d " adjacents="%s" />\n' % \
+                              (face[0], face[1], face[2], face[3],
+                               ''.join('%d ' % num for num in lAdjacent[lOffsets[i]:lOffsets[i+1]])))
+            lLines.append('</faces>\n')
+            lLines.append('</navmesh>\n')
+
             with open(sPath+"/navmesh.xml", "w", encoding="utf8", newline="\n") as navmeshfile:
-                navmesh_obj = self.m_objects[0]
-                bm = bmesh.new()
-                mm = navmesh_obj.to_mesh()
-                bm.from_mesh(mm)
-                om = navmesh_obj.matrix_world
-                navmesh_obj.to_mesh_clear()
-
-                navmeshfile.write('<?xml version="1.0" encoding=\"utf-8\"?>\n')
-                navmeshfile.write('<navmesh>\n')
-                min_height_testing = stk_utils.getObjectProperty(navmesh_obj, "min_height_testing", -1.0)
-                max_height_testing = stk_utils.getObjectProperty(navmesh_obj, "max_height_testing", 5.0)
-                navmeshfile.write('<height-testing min="%f" max="%f"/>\n' % (min_height_testing, max_height_testing))
-                navmeshfile.write('<MaxVertsPerPoly nvp="4" />\n')
-                navmeshfile.write('<vertices>\n')
-
-                for vert in bm.verts:
-                    navmeshfile.write('<vertex x="%f" y="%f" z="%f" />\n' % ((om@vert.co).x, (om@vert.co).z, (om@vert.co).y))
-
-                navmeshfile.write('</vertices>\n')
-                navmeshfile.write('<faces>\n')
-
-                for face in bm.faces:
-                    navmeshfile.write('<face indices="')
-                    if len(face.verts) != 4:
-                        self.log.report({'ERROR'}, 'Use only quad for navmesh, face %d not quad!' % face.index)
-                        self.log.report({'ERROR'}, 'To find it out, select the navmesh object and toggle edit mode, than in python console:')
-                        self.log.report({'ERROR'}, 'me = bpy.data.objects[\'%s\'].data' % self.m_objects[0].name)
-                        self.log.report({'ERROR'}, 'import bmesh')
-                        self.log.report({'ERROR'}, 'bm = bmesh.from_edit_mesh(me)')
-                        self.log.report({'ERROR'}, 'bm.faces[%d].select = True' % face.index)
-                        self.log.report({'ERROR'}, 'bmesh.update_edit_mesh(me, True)')
-                        assert False
-                    for vert in face.verts:
-                        navmeshfile.write('%d ' % vert.index)
-
-                    list_face = []
-                    unique_face = []
-                    for edge in face.edges:
-                        for l_face in edge.link_faces:
-                            list_face.append(l_face.index)
-
-                    [unique_face.append(item) for item in list_face if item not in unique_face]
-                    unique_face.remove(face.index) #remove current face index
-
-                    navmeshfile.write('" adjacents="')
-                    for num in unique_face:
-                        navmeshfile.write('%d ' % num)
-                    navmeshfile.write('" />\n')
-
-                navmeshfile.write('</faces>\n')
-                navmeshfile.write('</navmesh>\n')
+                navmeshfile.write(''.join(lLines))
+
+            if stk_utils.getObjectProperty(navmesh_obj, "binary_navmesh", "false") == "true":
+                with open(sPath+"/navmesh.bin", "wb") as navmeshfile:
+                    navmeshfile.write(struct.pack("<4sHHffIII", b"STKN", 1, 4,
+                                                  min_height_testing, max_height_testing,
+                                                  len(vertices), len(faces), len(adjacent)))
+                    for data in self.getNavmeshBytes(navmesh):
+                        navmeshfile.write(data)
+
+            if stk_utils.getObjectProperty(navmesh_obj, "navmesh_routes", "false") == "true":
+                self.exportNavmeshRoutes(sPath, navmesh)
+
+    # --------------------------------------------------------------------------
+    # Returns the navmesh arrays (see getNavmeshArrays) as little endian
+    # bytes, in the order they are stored in navmesh.bin.
+    def getNavmeshBytes(self, navmesh):
+        (vertices, faces, offsets, adjacent) = navmesh
+        return [vertices.astype("<f4").tobytes(), faces.astype("<u4").tobytes(),
+                offsets.astype("<u4").tobytes(), adjacent.astype("<u4").tobytes()]
+
+    # --------------------------------------------------------------------------
+    # Computes the shortest distance between all pairs of navmesh faces and
+    # the next face to drive to on that path, over the distances between the
+    # centers of adjacent faces. Only the sparse adjacency is used: the
+    # distances from a face are lowered to |face w| + distance[w] for each
+    # neighbour w, one face at a time in breadth first order, alternating
+    # with the reverse order, until a sweep changes nothing. Each sweep
+    # carries the distances along the whole navmesh, so a few sweeps are
+    # enough instead of the n steps of Floyd-Warshall over dense matrices.
+    # The next face towards j is then the first neighbour w of the face with
+    # |face w| + distance[w][j] equal to the distance. Unreachable faces have
+    # an infinite distance and a next face of -1.
+    def computeNavmeshRoutes(self, navmesh):
+        (vertices, faces, offsets, adjacent) = navmesh
+        n = len(faces)
+        centers = vertices[faces].mean(axis=1)
+        degree = np.diff(offsets)
+        owner = np.repeat(np.arange(n), degree)
+        edge_length = np.linalg.norm(centers[owner] - centers[adjacent], axis=1).astype(np.float32)
+
+        # Faces in breadth first order, each connected part from its first face
+        lOrder = []
+        visited = np.zeros(n, dtype=bool)
+        for root in range(n):
+            if visited[root]:
+                continue
+            visited[root] = True
+            first = len(lOrder)
+            lOrder.append(root)
+            while first < len(lOrder):
+                face = lOrder[first]
+                first += 1
+                for neighbour in adjacent[offsets[face]:offsets[face+1]].tolist():
+                    if not visited[neighbour]:
+                        visited[neighbour] = True
+                        lOrder.append(neighbour)
+        lOrder = [face for face in lOrder if degree[face] > 0]
+
+        # The candidate rows are the distances from the neighbours of one face
+        distance = np.full((n, n), np.inf, dtype=np.float32)
+        np.fill_diagonal(distance, 0.0)
+        candidate = np.empty((int(degree.max()) if n > 0 else 0, n), dtype=np.float32)
+        best = np.empty(n, dtype=np.float32)
+        changed = True
+        while changed:
+            changed = False
+            for face in lOrder:
+                (start, end) = (offsets[face], offsets[face+1])
+                rows = candidate[:end-start]
+                np.take(distance, adjacent[start:end], axis=0, out=rows)
+                rows += edge_length[start:end, None]
+                rows.min(axis=0, out=best)
+                if (best < distance[face]).any():
+                    np.minimum(distance[face], best, out=distance[face])
+                    changed = True
+            lOrder.reverse()
+
+        next_face = np.full((n, n), -1, dtype=np.int32)
+        for face in lOrder:
+            (start, end) = (offsets[face], offsets[face+1])
+            rows = candidate[:end-start]
+            np.take(distance, adjacent[start:end], axis=0, out=rows)
+            rows += edge_length[start:end, None]
+            next_face[face] = adjacent[start:end][np.argmax(rows == distance[face], axis=0)]
+            next_face[face, np.isinf(distance[face])] = -1
+        np.fill_diagonal(next_face, np.arange(n))
+        return (distance, next_face)
+
+    # --------------------------------------------------------------------------
+    # Writes navmesh_routes.bin, the all-pairs distance and next face tables.
+    # The file is keyed by a hash of the navmesh (the data of navmesh.bin), so
+    # that the game can check it belongs to the navmesh, and an up to date
+    # file is not computed again. Its layout is: b'STKR', uint16 version,
+    # uint16 size of a face index (2 or 4), 16 bytes navmesh hash, uint32 face
+    # count, the float32 distance matrix and the signed next face matrix (both
+    # row major, row = from face, column = to face).
+    def exportNavmeshRoutes(self, sPath, navmesh):
+        navmesh_hash = hashlib.blake2b(digest_size=16)
+        for data in self.getNavmeshBytes(navmesh):
+            navmesh_hash.update(data)
+        navmesh_hash = navmesh_hash.digest()
+        n = len(navmesh[1])
+        index_size = 2 if n < 32768 else 4
+
+        header = struct.pack("<4sHH16sI", b"STKR", 1, index_size, navmesh_hash, n)
+        sFile = sPath+"/navmesh_routes.bin"
+        try:
+            with open(sFile, "rb") as routesfile:
+                if routesfile.read(len(header)) == header and \
+                   routesfile.seek(0, 2) == len(header) + n*n*(4 + index_size):
+                    print("Navmesh routes are up to date, skipping")
+                    return
+        except OSError:
+            pass
+
+        (distance, next_face) = self.computeNavmeshRoutes(navmesh)
+        with open(sFile, "wb") as routesfile:
+            routesfile.write(header)
+            routesfile.write(distance.astype("<f4").tobytes())
+            routesfile.write(next_face.astype("<i2" if index_size == 2 else "<i4").tobytes())
 
 # ------------------------------------------------------------------------------
 class DrivelineExporter:
@@ -816,13 +1392,14 @@ class DrivelineExporter:
 
     # --------------------------------------------------------------------------
     # Find the driveline from lRemain that is closest to any of the drivelines
-    # in lSorted.
-    def findClosestDrivelineToDrivelines(self, lRemain, lSorted):
+    # in lSorted. lClosest contains for each driveline in lRemain the
+    # (distance, sorted index, quad) tuple of the closest quad in lSorted.
+    def findClosestDrivelineToDrivelines(self, lRemain, lClosest):
         remain_index                    = 0
-        (min_dist, sorted_index, min_quad) = lRemain[0].getDistanceToStart(lSorted)
+        (min_dist, sorted_index, min_quad) = lClosest[0]
         for i in range(1, len(lRemain)):
-            (dist, index, quad) = lRemain[i].getDistanceToStart(lSorted)
-            if dist<min_dist:
+            (dist, index, quad) = lClosest[i]
+            if dist is not None and (min_dist is None or dist<min_dist):
                 min_dist     = dist
                 sorted_index = index
                 min_quad     = quad
@@ -878,27 +1455,27 @@ class DrivelineExporter:
         # since this list is later sorted by quad index, so that the
         # first camera is the first in the list.
         lCamerasDistance = []
+        lUnmatchedCameras = []
+        quad_index_sorted = DrivelineQuadIndex(lSorted)
         for i in range(len(lEndCameras)):
             cam = lEndCameras[i]
-            try:
-                (distance, driveline_index, quad_index_camera) = \
-                           lSorted[0].getDistanceTo(cam.location, lSorted)
-                # Each list contains the index of the closest quad, the
-                # distance, and then the camera
-                lEndCameras[i] = (driveline_index, quad_index_camera, cam)
-            except:
-                self.log.report({'WARNING'}, "Problem with the end camera '%s'. Check if the main driveline is " +\
+            (distance, driveline_index, quad_index_camera) = \
+                       quad_index_sorted.findClosestQuad(cam.location)
+            if driveline_index is None:
+                # No quad to compare with, keep the camera after the sorted ones
+                self.log.report({'WARNING'}, ("Problem with the end camera '%s'. Check if the main driveline is " +\
                             "properly defined (check warning messages), and the " +\
-                            "settings of the camera."%cam.name)
+                            "settings of the camera.")%cam.name)
+                lUnmatchedCameras.append(cam)
+                continue
+            # Each list contains the index of the closest quad, the original
+            # index as tie breaker, and then the camera
+            lCamerasDistance.append((driveline_index, quad_index_camera, i, cam))
 
-        lEndCameras.sort()
+        lCamerasDistance.sort()
 
-        # After sorting remove the unnecessary distance and quad index
-        for i in range(len(lEndCameras)):
-            # Avoid crash in case that some problem with the camera happened,
-            # and lEndCameras is just the blender camera, not the tuple
-            if type(lEndCameras[i])==type(()):
-                lEndCameras[i] = lEndCameras[i][2]
+        # After sorting remove the unnecessary quad and camera index
+        lEndCameras[:] = [t[3] for t in lCamerasDistance] + lUnmatchedCameras
 
         # There were already two warning messages printed at this stage, so just
         # ignore this to avoid further crashes
@@ -912,19 +1489,30 @@ class DrivelineExporter:
 
         # Now add the remaining drivelines one at a time. From all remaining
         # drivelines we pick the one closest to the drivelines contained in
-        # lSorted.
+        # lSorted. The closest quad of each remaining driveline only has to
+        # be compared with the quads of each newly sorted driveline.
+        quad_index_sorted = DrivelineQuadIndex(lSorted)
+        lClosest = [quad_index_sorted.findClosestQuad(driveline.getStartPoint())
+                    for driveline in lRemain]
         while lRemain:
-            t = self.findClosestDrivelineToDrivelines(lRemain, lSorted)
+            t = self.findClosestDrivelineToDrivelines(lRemain, lClosest)
             (remain_index, sorted_index, quad_to_index) = t
             lRemain[remain_index].setFromQuad(lSorted[sorted_index],
                                               quad_to_index)
             lSorted.append(lRemain[remain_index])
             del lRemain[remain_index]
+            del lClosest[remain_index]
 
             # Set the start quad index for all quads.
             lSorted[-1].setStartQuadIndex(quad_index)
             quad_index = quad_index + lSorted[-1].getNumberOfQuads()
 
+            quad_index_new = DrivelineQuadIndex([lSorted[-1]])
+            for i in range(len(lRemain)):
+                (dist, index, quad) = quad_index_new.findClosestQuad(lRemain[i].getStartPoint())
+                if dist is not None and (lClosest[i][0] is None or dist < lClosest[i][0]):
+                    lClosest[i] = (dist, len(lSorted) - 1, quad)
+
     # --------------------------------------------------------------------------
     # Writes the track.quad file with the list of all quads, and the track.graph
     # file defining a graph node for each quad and a basic connection between
@@ -999,6 +1587,7 @@ class DrivelineExporter:
             # as its begin connection. To avoid this, we keep track of all
             # written from/to edges, and only write one if it hasn't been written.
             dWrittenEdges={}
+            quad_index_sorted = DrivelineQuadIndex(lSorted)
             # Now write the remaining drivelines
             for driveline in lSorted:
                 # Mainline was already written, so ignore it
@@ -1024,13 +1613,140 @@ class DrivelineExporter:
                             %(driveline.getFirstQuadIndex(),
                               driveline.getLastQuadIndex()))
                 fr = driveline.getLastQuadIndex()
-                to = driveline.computeSuccessor(lSorted)
+                to = driveline.computeSuccessor(lSorted, quad_index_sorted)
                 if (fr, to) not in dWrittenEdges:
                     f.write("  <edge from=\"%d\" to=\"%d\"/>\n" %(fr, to))
                     dWrittenEdges[ (fr, to) ] = 1
             f.write("</graph>\n")
         #print bsys.time()-start_time,"seconds. "
 
+        self.writeQuadGrid(sPath, lSorted)
+
+        resolution = int(stk_utils.getSceneProperty(bpy.data.scenes[0], "minimap_resolution", 0))
+        if resolution > 0:
+            self.writeMinimap(sPath, lSorted, resolution)
+
+    # --------------------------------------------------------------------------
+    # Rasterizes the quads of all visible drivelines (seen from above, STK x
+    # to the right and z up) into minimap.png, white on a transparent
+    # background, with resolution pixels along the longer side. The pixels
+    # inside a quad are filled with a scanline algorithm: for every (quad,
+    # pixel row) pair the crossings of the row center with the quad sides
+    # give the spans to fill, which are accumulated with one difference
+    # array for the whole image. minimap.xml stores the world to image
+    # transform.
+    def writeMinimap(self, sPath, lSorted, resolution):
+        lVisible = [driveline for driveline in lSorted if driveline.invisible != "true"]
+        if not lVisible:
+            return
+        corners = np.concatenate([driveline.getQuadCorners() for driveline in lVisible])
+        if len(corners) == 0:
+            return
+        # Image coordinates (in world units): x to the right, -z down
+        points = corners[:, :, [0, 2]] * [1.0, -1.0]
+        origin = points.reshape(-1, 2).min(axis=0)
+        size = points.reshape(-1, 2).max(axis=0) - origin
+        scale = (resolution - 2) / max(size.max(), 1e-6)
+        # One pixel of border on every side
+        points = (points - origin) * scale + 1.0
+        (width, height) = (np.ceil(size * scale).astype(np.int64) + 2).tolist()
+
+        # All (quad, row) pairs, a row is inside if its center is
+        row_min = np.ceil(points[:, :, 1].min(axis=1) - 0.5).astype(np.int64)
+        row_max = np.ceil(points[:, :, 1].max(axis=1) - 0.5).astype(np.int64)
+        count = np.maximum(row_max - row_min, 0)
+        quad = np.repeat(np.arange(len(points)), count)
+        row = row_min[quad] + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        y = row + 0.5
+
+        # Crossings of the row with the 4 sides of its quad (NaN if none),
+        # sorted so that they pair up into spans (even-odd rule).
+        start = points[quad]
+        end = np.roll(start, -1, axis=1)
+        crossed = (start[:, :, 1] <= y[:, None]) != (end[:, :, 1] <= y[:, None])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (y[:, None] - start[:, :, 1]) / (end[:, :, 1] - start[:, :, 1])
+        x = np.where(crossed, start[:, :, 0] + t * (end[:, :, 0] - start[:, :, 0]), np.nan)
+        x = np.sort(x, axis=1)
+
+        coverage = np.zeros((height, width + 1), dtype=np.int32)
+        for span in (0, 2):
+            valid = ~np.isnan(x[:, span + 1])
+            first = np.clip(np.ceil(x[valid, span] - 0.5), 0, width).astype(np.int64)
+            last = np.clip(np.ceil(x[valid, span + 1] - 0.5), 0, width).astype(np.int64)
+            np.add.at(coverage, (row[valid], first), 1)
+            np.add.at(coverage, (row[valid], last), -1)
+        filled = np.cumsum(coverage, axis=1)[:, :width] > 0
+
+        image = np.zeros((height, width, 2), dtype=np.uint8)
+        image[filled] = 255
+        writePNG(sPath + "/minimap.png", image)
+
+        # Image coordinates of a world point (x, z): ((x - x0) * scale + 1,
+        # (z0 - z) * scale + 1)
+        with open(sPath + "/minimap.xml", "w", encoding="utf8", newline="\n") as f:
+            f.write("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n")
+            f.write("<minimap image=\"minimap.png\" width=\"%d\" height=\"%d\" x=\"%f\" z=\"%f\" scale=\"%f\" border=\"1\"/>\n" % \
+                    (width, height, origin[0], -origin[1], scale))
+
+    # --------------------------------------------------------------------------
+    # Writes quads_grid.bin, a uniform 2D grid (on the ground plane, i.e. STK
+    # x and z) over all quads, so that the quad at a position can be found
+    # without testing all quads. Each quad is listed in every cell its
+    # bounding box overlaps. The cell size is twice the median quad size. The
+    # file is keyed by a hash of the quad corners, and its layout is:
+    # b'STKG', uint16 version, uint16 0, 16 bytes quad hash, float32 min x,
+    # min z and cell size, uint32 cell count in x and z, quad count and index
+    # count, uint32 (cell count + 1) offsets into the indices and the uint32
+    # quad indices (cell (x, z) is cell z * cell count in x + x).
+    def writeQuadGrid(self, sPath, lSorted):
+        corners = np.concatenate([driveline.getQuadCorners() for driveline in lSorted])
+        if len(corners) == 0:
+            return
+        quad_hash = hashlib.blake2b(corners.astype("<f4").tobytes(), digest_size=16).digest()
+
+        quad_min = corners[:, :, [0, 2]].min(axis=1)
+        quad_max = corners[:, :, [0, 2]].max(axis=1)
+        grid_min = quad_min.min(axis=0)
+        grid_size = quad_max.max(axis=0) - grid_min
+        cell_size = max(2.0 * float(np.median((quad_max - quad_min).max(axis=1))), 1.0)
+        # Keep the grid at a reasonable size for huge or degenerate tracks
+        while np.prod(np.floor(grid_size / cell_size) + 1) > 1 << 20:
+            cell_size *= 2.0
+        (nx, nz) = (np.floor(grid_size / cell_size).astype(np.int64) + 1).tolist()
+
+        cell_min = np.floor((quad_min - grid_min) / cell_size).astype(np.int64)
+        cell_max = np.minimum(np.floor((quad_max - grid_min) / cell_size).astype(np.int64), [nx-1, nz-1])
+        cell_count = cell_max - cell_min + 1
+
+        # One entry per (quad, overlapped cell)
+        count = cell_count[:, 0] * cell_count[:, 1]
+        quad = np.repeat(np.arange(len(corners)), count)
+        local = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        cell_x = cell_min[quad, 0] + local % cell_count[quad, 0]
+        cell_z = cell_min[quad, 1] + local // cell_count[quad, 0]
+        cell = cell_z * nx + cell_x
+
+        order = np.argsort(cell, kind="stable")
+        indices = quad[order]
+        occupancy = np.bincount(cell, minlength=nx*nz)
+        offsets = np.zeros(nx*nz + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(occupancy)
+
+        with open(sPath + "/quads_grid.bin", "wb") as f:
+            f.write(struct.pack("<4sHH16sfffIIII", b"STKG", 1, 0, quad_hash,
+                                grid_min[0], grid_min[1], cell_size,
+                                nx, nz, len(corners), len(indices)))
+            f.write(offsets.astype("<u4").tobytes())
+            f.write(indices.astype("<u4").tobytes())
+
+        worst = int(occupancy.argmax())
+        self.log.report({'INFO'}, "Driveline quad grid: %d x %d cells of %.1f m, at most %d quads in a cell (around %.1f %.1f), %.1f on average" % \
+                        (nx, nz, cell_size, occupancy[worst],
+                         grid_min[0] + (worst % nx + 0.5) * cell_size,
+                         grid_min[1] + (worst // nx + 0.5) * cell_size,
+                         occupancy[occupancy > 0].mean()))
+
     # Write out a goal line
     def writeGoal(self, f, goal):
         if len(goal.data.vertices) != 2:
@@ -1187,9 +1903,8 @@ class DrivelineExporter:
                     self.writeGoal(f, obj)
                     continue
 
-                mesh = obj.data.copy()
                 # Convert to world space
-                mesh.transform(obj.matrix_world)
+                co = getWorldVertexPositions(obj)
                 # One of lap, activate, toggle, ambient
                 activate = stk_utils.getObjectProperty(obj, "activate", "")
                 kind=" "
@@ -1252,10 +1967,10 @@ class DrivelineExporter:
                 height_up = stk_utils.getObjectProperty(obj, "height-up", 10.0)
                 height_down = stk_utils.getObjectProperty(obj, "height-down", 2.0)
 
-                if len(mesh.vertices)==2:   # Check line
+                if len(co)==2:   # Check line
                     f.write("    <check-line%sp1=\"%.2f %.2f %.2f\" p2=\"%.2f %.2f %.2f\"\n" %
-                            (kind, mesh.vertices[0].co[0], mesh.vertices[0].co[2], mesh.vertices[0].co[1],
-                             mesh.vertices[1].co[0], mesh.vertices[1].co[2], mesh.vertices[1].co[1]   )  )
+                            (kind, co[0][0], co[0][2], co[0][1],
+                             co[1][0], co[1][2], co[1][1]   )  )
                     if self.is_track and bpy.context.scene['track_version'] == 8:
                         f.write("                height-up=\"%.2f\" height-down=\"%.2f\" same-group=\"%s\"/>\n" \
                                 % (height_up, height_down, sSameGroup.strip()))
@@ -1264,10 +1979,10 @@ class DrivelineExporter:
                                 % (sSameGroup.strip()))
                 else:
                     radius = 0
-                    for v in mesh.vertices:
+                    for v in co:
                         r = (obj.location[0]-v[0])*(obj.location[0]-v[0]) + \
                             (obj.location[1]-v[1])*(obj.location[1]-v[1]) + \
-                            (obj.location[2]-v[2])*(obj.loc[2]-v[2])
+                            (obj.location[2]-v[2])*(obj.location[2]-v[2])
                         if r > radius:
                             radius = r
 
@@ -1283,6 +1998,81 @@ class DrivelineExporter:
                 self.log.report({'ERROR'}, "Error exporting checkline " + obj.name + ", make sure it is properly formed")
         f.write("  </checks>\n")
 
+# ==============================================================================
+# Writes an 8 bit image (rows x columns x channels, with 1 to 4 channels:
+# gray, gray and alpha, RGB, RGBA) as a PNG file.
+def writePNG(sFile, image):
+    (height, width, channels) = image.shape
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    # Every row starts with filter type 0 (none)
+    data = np.zeros((height, width * channels + 1), dtype=np.uint8)
+    data[:, 1:] = image.reshape(height, -1)
+
+    def chunk(name, content):
+        return struct.pack(">I", len(content)) + name + content + \
+               struct.pack(">I", zlib.crc32(name + content) & 0xffffffff)
+
+    with open(sFile, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(data.tobytes(), 9)))
+        f.write(chunk(b"IEND", b""))
+
+# ==============================================================================
+# Spatial index (KD-tree) of the quad centres of a list of drivelines, used to
+# find the quad closest to a point without testing every quad of every
+# driveline.
+class DrivelineQuadIndex:
+    def __init__(self, lDrivelines):
+        self.lDrivelines = lDrivelines
+        # (driveline index, quad index) of each point in the tree
+        self.lQuads = []
+        for driveline_index, driveline in enumerate(lDrivelines):
+            for quad_index in range(len(driveline.lCenter)):
+                self.lQuads.append((driveline_index, quad_index))
+
+        self.tree = kdtree.KDTree(len(self.lQuads))
+        for i, (driveline_index, quad_index) in enumerate(self.lQuads):
+            self.tree.insert(lDrivelines[driveline_index].lCenter[quad_index], i)
+        self.tree.balance()
+
+    # --------------------------------------------------------------------------
+    # Returns the squared distance from p to the closest quad centre, the
+    # index of its driveline in lDrivelines and the local index of the quad
+    # within this driveline, ignoring the quads of the driveline exclude.
+    def findClosestQuad(self, p, exclude=None):
+        if not self.lQuads: return (None, None, None)
+
+        if exclude is None:
+            (co, index, dist) = self.tree.find(p)
+        else:
+            (co, index, dist) = self.tree.find(p, filter=lambda i:
+                self.lDrivelines[self.lQuads[i][0]] is not exclude)
+        if index is None: return (None, None, None)
+
+        (driveline_index, quad_index) = self.lQuads[index]
+        return (dist*dist, driveline_index, quad_index)
+
+# ==============================================================================
+# Returns the world space vertex coordinates of a mesh object as a n x 3
+# array. The coordinates are read in bulk and transformed with numpy, so no
+# temporary mesh datablock is created.
+def getWorldVertexPositions(obj):
+    mesh = obj.data
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+
+    matrix = np.array(obj.matrix_world, dtype=np.float64)
+    return co.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+
+# Returns the world space vertex coordinates (see getWorldVertexPositions) and
+# the edges (as a n x 2 array of vertex indices) of a mesh object.
+def getWorldMeshArrays(obj):
+    mesh = obj.data
+    edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+    mesh.edges.foreach_get("vertices", edges)
+    return getWorldVertexPositions(obj), edges.reshape(-1, 2)
+
 # ==============================================================================
 # A special class to store a driveline.
 class Driveline:
@@ -1290,9 +2080,8 @@ class Driveline:
         self.name      = driveline.name
         self.is_main   = is_main
         self.log = log
-        # Transform the mesh to the right coordinates.
-        self.mesh      = driveline.data.copy()
-        self.mesh.transform(driveline.matrix_world)
+        # World space coordinates of all vertices and the list of edges.
+        self.co, self.edges = getWorldMeshArrays(driveline)
         # Convert the mesh into a dictionary: each vertex is a key to a
         # list of neighbours.
         self.createNeighbourDict()
@@ -1380,6 +2169,7 @@ class Driveline:
     # in calls to getNumberOfQuads etc).
     def setIsLastMain(self, first_driveline):
         self.is_last_main = 1
+        self.first_driveline = first_driveline
         cp=[]
 
         for i in range(3):
@@ -1387,10 +2177,10 @@ class Driveline:
             if self.lRight[-1] is None or self.lLeft[-1] is None:
                 return # Invalid driveline (an error message will have been printed)
 
-            cp.append((self.mesh.vertices[self.lLeft[-1]].co[i] +
-                       first_driveline.mesh.vertices[first_driveline.lLeft[0]].co[i]+
-                       self.mesh.vertices[self.lRight[-1]].co[i] +
-                       first_driveline.mesh.vertices[first_driveline.lRight[0]].co[i])*0.25)
+            cp.append((self.co[self.lLeft[-1]][i] +
+                       first_driveline.co[first_driveline.lLeft[0]][i]+
+                       self.co[self.lRight[-1]][i] +
+                       first_driveline.co[first_driveline.lRight[0]][i])*0.25)
 
         self.lCenter.append(cp)
         self.lLeft.append(None)
@@ -1401,16 +2191,16 @@ class Driveline:
     # of all its neighbours.
     def createNeighbourDict(self):
         self.dNext = {}
-        for e in self.mesh.edges:
-            if e.vertices[0] in self.dNext:
-                self.dNext[e.vertices[0]].append(e.vertices[1])
+        for (v0, v1) in self.edges.tolist():
+            if v0 in self.dNext:
+                self.dNext[v0].append(v1)
             else:
-                self.dNext[e.vertices[0]] = [e.vertices[1]]
+                self.dNext[v0] = [v1]
 
-            if e.vertices[1] in self.dNext:
-                self.dNext[e.vertices[1]].append(e.vertices[0])
+            if v1 in self.dNext:
+                self.dNext[v1].append(v0)
             else:
-                self.dNext[e.vertices[1]] = [e.vertices[0]]
+                self.dNext[v1] = [v0]
 
     # --------------------------------------------------------------------------
     # This helper function determines the start vertex for a driveline.
@@ -1431,14 +2221,12 @@ class Driveline:
         print("self.lStart[0] =", self.lStart[0])
         print("self.lStart[1] =", self.lStart[1])
 
-        start_coord_1 = self.mesh.vertices[self.lStart[0]].co
-        start_coord_2 = self.mesh.vertices[self.lStart[1]].co
+        start_coord_1 = self.co[self.lStart[0]]
+        start_coord_2 = self.co[self.lStart[1]]
 
         # Save the middle of the first quad, which is used later for neareast
         # quads computations.
-        self.start_point = ((start_coord_1[0] + start_coord_2[0])*0.5,
-                            (start_coord_1[1] + start_coord_2[1])*0.5,
-                            (start_coord_1[2] + start_coord_2[2])*0.5 )
+        self.start_point = tuple(((start_coord_1 + start_coord_2)*0.5).tolist())
 
     # --------------------------------------------------------------------------
     # Returns the startline of this driveline
@@ -1477,10 +2265,10 @@ class Driveline:
         # expectes counter-clockwise, so if the orientation is wrong, swap
         # left and right side.
 
-        left_0_coord = self.mesh.vertices[self.lLeft[0]].co
-        #left_1_coord = self.mesh.vertices[self.lLeft[1]].co
-        right_0_coord = self.mesh.vertices[self.lRight[0]].co
-        right_1_coord = self.mesh.vertices[self.lRight[1]].co
+        left_0_coord = self.co[self.lLeft[0]]
+        #left_1_coord = self.co[self.lLeft[1]]
+        right_0_coord = self.co[self.lRight[0]]
+        right_1_coord = self.co[self.lRight[1]]
 
         if (right_1_coord[0] - left_0_coord[0])*(right_0_coord[1] - left_0_coord[1]) \
          - (right_1_coord[1] - left_0_coord[1])*(right_0_coord[0] - left_0_coord[0]) > 0:
@@ -1494,7 +2282,7 @@ class Driveline:
         # which the first line of the main driveline is converted) is on the
         # left side (this only applies for the lap counting line, see
         # Track::setStartCoordinates/getStartTransform).
-        self.start_line = (self.mesh.vertices[self.lLeft[1]].co, self.mesh.vertices[self.lRight[1]].co)
+        self.start_line = (self.co[self.lLeft[1]], self.co[self.lRight[1]])
 
         count=0
         # Just in case that we have an infinite loop due to a malformed graph:
@@ -1522,13 +2310,13 @@ class Driveline:
                 break
 
             if len(next_left)!=1 and not warning_printed:
-                lcoord = self.mesh.vertices[self.lLeft[-1]].co
-                rcoord = self.mesh.vertices[self.lRight[-1]].co
+                lcoord = self.co[self.lLeft[-1]]
+                rcoord = self.co[self.lRight[-1]]
                 self.log.report({'WARNING'}, "Broken driveline at or around point ({0}, {1}, {2})".format\
                             (lcoord[0], lcoord[1], lcoord[2]))
                 print("Potential successors :")
                 for i in range(len(next_left)):
-                    nextco = self.mesh.vertices[next_left[i]].co
+                    nextco = self.co[next_left[i]]
                     print ("Successor %d: %f %f %f" % \
                           (i, nextco[0], nextco[1], nextco[2]))
                 print ("It might also possible that the corresponding right driveline point")
@@ -1557,8 +2345,8 @@ class Driveline:
                 next_right.append(i)
 
             if len(next_right)==0:
-                lcoord = self.mesh.vertices[self.lLeft[-1]].co
-                rcoord = self.mesh.vertices[self.lRight[-1]].co
+                lcoord = self.co[self.lLeft[-1]]
+                rcoord = self.co[self.lRight[-1]]
                 self.log.report({'WARNING'}, "Malformed driveline at or around points ({0}, {1}, {2}) and ({3}, {4}, {5})".format\
                              (lcoord[0],lcoord[1],lcoord[2],
                               rcoord[0],rcoord[1],rcoord[2]))
@@ -1570,8 +2358,8 @@ class Driveline:
                 break
 
             if len(next_right)!=1 and not warning_printed:
-                lcoord = self.mesh.vertices[self.lLeft[-1]].co
-                rcoord = self.mesh.vertices[self.lRight[-1]].co
+                lcoord = self.co[self.lLeft[-1]]
+                rcoord = self.co[self.lRight[-1]]
 
                 self.log.report({'ERROR'}, "Invalid driveline at or around point ({0}, {1}, {2})".format\
                           (rcoord[0],rcoord[1],rcoord[2]))
@@ -1595,13 +2383,9 @@ class Driveline:
             processed_vertices[self.lRight[-2]] = True
             processed_vertices[self.lLeft[-2]] = True
 
-            cp=[]
-            for i in range(3):
-                cp.append((self.mesh.vertices[self.lLeft[-2]].co[i] +
-                           self.mesh.vertices[self.lLeft[-1]].co[i] +
-                           self.mesh.vertices[self.lRight[-2]].co[i] +
-                           self.mesh.vertices[self.lRight[-1]].co[i])*0.25)
-            self.lCenter.append(cp)
+            cp = (self.co[self.lLeft[-2]] + self.co[self.lLeft[-1]] +
+                  self.co[self.lRight[-2]] + self.co[self.lRight[-1]])*0.25
+            self.lCenter.append(cp.tolist())
 
         if count>=max_count and not warning_printed:
             self.log.report({'WARNING'}, "Warning, Only the first %d vertices of driveline '%s' are exported" %\
@@ -1609,37 +2393,46 @@ class Driveline:
 
         if warning_printed != 1:
 
-            not_connected = None
-            not_connected_distance = 99999
-
+            # Group the vertices that were not processed into separate sections
+            # (connected components), each section is reported once
+            lSections = []
+            dSection  = {}
             for v in self.dNext:
-                if not v in processed_vertices:
-
-                    # find closest connected vertex (this is only to improve the error message)
-                    for pv in processed_vertices:
-                        dist = (self.mesh.vertices[v].co - self.mesh.vertices[pv].co).length
-                        if dist < not_connected_distance:
-                            not_connected_distance = dist
-                            not_connected = v
-
-            if not_connected:
-                self.log.report({'WARNING'}, "Warning, driveline '%s' appears to be broken in separate sections. Vertex at %f %f %f is not connected with the rest" % \
-                                    (self.name,
-                                     self.mesh.vertices[not_connected].co[0],
-                                     self.mesh.vertices[not_connected].co[1],
-                                     self.mesh.vertices[not_connected].co[2]))
+                if v in processed_vertices or v in dSection: continue
+                section = [v]
+                dSection[v] = len(lSections)
+                # section grows while it is iterated (breadth first search)
+                for sv in section:
+                    for n in self.dNext[sv]:
+                        if n not in processed_vertices and n not in dSection:
+                            dSection[n] = len(lSections)
+                            section.append(n)
+                lSections.append(section)
+
+            if lSections:
+                # find closest connected vertex (this is only to improve the error message)
+                tree = kdtree.KDTree(len(processed_vertices))
+                for pv in processed_vertices:
+                    tree.insert(self.co[pv], pv)
+                tree.balance()
+
+                for section in lSections:
+                    (not_connected_distance, not_connected) = \
+                        min((tree.find(self.co[v])[2], v) for v in section)
+                    self.log.report({'WARNING'}, "Warning, driveline '%s' appears to be broken in separate sections. Vertex at %f %f %f is not connected with the rest (section of %d vertices)" % \
+                                        (self.name,
+                                         self.co[not_connected][0],
+                                         self.co[not_connected][1],
+                                         self.co[not_connected][2],
+                                         len(section)))
 
 
         # Now remove the first two points, which are only used to indicate
         # the starting point:
         del self.lLeft[0]
         del self.lRight[0]
-        self.end_point =((self.mesh.vertices[self.lLeft[-1]].co[0] +
-                          self.mesh.vertices[self.lRight[-1]].co[0])*0.5,
-                         (self.mesh.vertices[self.lLeft[-1]].co[1] +
-                          self.mesh.vertices[self.lRight[-1]].co[1])*0.5,
-                         (self.mesh.vertices[self.lLeft[-1]].co[2] +
-                          self.mesh.vertices[self.lRight[-1]].co[2])*0.5 )
+        self.end_point = tuple(((self.co[self.lLeft[-1]] +
+                                 self.co[self.lRight[-1]])*0.5).tolist())
 
     # --------------------------------------------------------------------------
     # Returns the end point of this driveline
@@ -1657,50 +2450,52 @@ class Driveline:
     # start point of this driveline to all quads of all drivelines in
     # lDrivelines. This function returns the distance, the index of the
     # driveline in lDrivelines, and the local index of the quad within this
-    # driveline as a tuple.
-    def getDistanceTo(self, p, lDrivelines):
+    # driveline as a tuple. quad_index can be a DrivelineQuadIndex of
+    # lDrivelines, to avoid building it for every call.
+    def getDistanceTo(self, p, lDrivelines, quad_index=None):
         if not lDrivelines: return (None, None, None)
 
-        (min_dist, min_quad_index) = lDrivelines[0].getMinDistanceToPoint(p)
-        min_driveline_index        = 0
-        for i in range(1, len(lDrivelines)):
-            if lDrivelines[i]==self: continue   # ignore itself
-            (dist, quad_index) = lDrivelines[i].getMinDistanceToPoint(p)
-            if dist < min_dist:
-                min_dist            = dist
-                min_quad_index      = quad_index
-                min_driveline_index = i
-        return (min_dist, min_driveline_index, min_quad_index)
-
-    # --------------------------------------------------------------------------
-    # Returns the minimum distance from the center point of each quad to the
-    # point p.
-    def getMinDistanceToPoint(self, p):
-        pCenter   = self.lCenter[0]
-        dx        = pCenter[0]-p[0]
-        dy        = pCenter[1]-p[1]
-        dz        = pCenter[2]-p[2]
-        min_dist  = dx*dx+dy*dy+dz*dz
-        min_index = 0
-        for i in range(1, len(self.lCenter)):
-            pCenter = self.lCenter[i]
-            dx      = pCenter[0]-p[0]
-            dy      = pCenter[1]-p[1]
-            dz      = pCenter[2]-p[2]
-            d       = dx*dx+dy*dy+dz*dz
-            if d<min_dist:
-                min_dist  = d
-                min_index = i
-        return (min_dist, min_index)
+        if quad_index is None:
+            quad_index = DrivelineQuadIndex(lDrivelines)
+        # ignore itself (unless it is the first driveline)
+        return quad_index.findClosestQuad(p, self if lDrivelines[0] is not self else None)
 
     # --------------------------------------------------------------------------
     # Determine the driveline from lSorted which is closest to this driveline's
     # endpoint (closest meaning: having a quad that is closest).
-    def computeSuccessor(self, lSorted):
+    def computeSuccessor(self, lSorted, quad_index_sorted=None):
         (dist, driveline_index, quad_index)=self.getDistanceTo(self.end_point,
-                                                               lSorted)
+                                                               lSorted,
+                                                               quad_index_sorted)
         return quad_index + lSorted[driveline_index].getFirstQuadIndex()
 
+    # --------------------------------------------------------------------------
+    # Returns the corners of the quads of this driveline as a (quads x 4 x 3)
+    # array in STK coordinates, in the order writeQuads writes them (p0 to
+    # p3). Quads of a broken driveline that are not written are left out.
+    def getQuadCorners(self):
+        if self.lLeft[0] is None or self.lRight[0] is None or \
+           self.lLeft[1] is None or self.lRight[1] is None:
+            return np.zeros((0, 4, 3))
+
+        max_index = len(self.lLeft) - 1
+        if self.is_last_main:
+            max_index = max_index - 1
+
+        lQuads = []
+        for i in range(max_index):
+            if self.lRight[i+1] is None: break
+            lQuads.append((self.lLeft[i], self.lRight[i], self.lRight[i+1], self.lLeft[i+1]))
+        corners = self.co[np.array(lQuads, dtype=np.int64).reshape(-1, 4)]
+
+        # The additional quad connecting the last main driveline to the start
+        if self.is_last_main and len(lQuads) == max_index:
+            first = self.first_driveline
+            last_quad = np.array([self.co[self.lLeft[max_index]], self.co[self.lRight[max_index]],
+                                  first.co[first.lRight[0]], first.co[first.lLeft[0]]])
+            corners = np.concatenate((corners, last_quad[None]))
+        return corners[:, :, [0, 2, 1]]
+
     # --------------------------------------------------------------------------
     # Writes the quads into a file.
     def writeQuads(self, f):
@@ -1710,10 +2505,10 @@ class Driveline:
         if self.lLeft[1] is None or self.lRight[1] is None:
             return # Invalid driveline (a message will have been printed)
 
-        l   = self.mesh.vertices[self.lLeft[0]].co
-        r   = self.mesh.vertices[self.lRight[0]].co
-        l1  = self.mesh.vertices[self.lLeft[1]].co
-        r1  = self.mesh.vertices[self.lRight[1]].co
+        l   = self.co[self.lLeft[0]]
+        r   = self.co[self.lRight[0]]
+        l1  = self.co[self.lLeft[1]]
+        r1  = self.co[self.lRight[1]]
 
         if self.invisible and self.invisible=="true":
             sInv = " invisible=\"yes\" "
@@ -1749,8 +2544,8 @@ class Driveline:
         for i in range(1, max_index):
             if self.lRight[i+1] is None: return # broken driveline (messages will already have been printed)
 
-            l1  = self.mesh.vertices[self.lLeft[i+1]].co
-            r1  = self.mesh.vertices[self.lRight[i+1]].co
+            l1  = self.co[self.lLeft[i+1]]
+            r1  = self.co[self.lRight[i+1]]
             f.write("  <quad%s%s%sp0=\"%d:3\" p1=\"%d:2\" p2=\"%.3f %.3f %.3f\" p3=\"%.3f %.3f %.3f\"/>\n" \
                     %(sInv,sAIIgnore if i == max_index - 1 else "",sDirection,self.global_quad_index_start+i-1, self.global_quad_index_start+i-1, \
                   r1[0],r1[2],r1[1], l1[0],l1[2],l1[1]) )
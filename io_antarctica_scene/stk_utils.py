@@ -20,7 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import bpy, os, base64, getpass, hashlib, xml.dom.minidom, pathlib, shutil, sys, traceback
+import bpy, os, base64, concurrent.futures, getpass, hashlib, json, xml.dom.minidom, pathlib, shutil, sys, traceback
 from collections import OrderedDict
 from xml.sax.saxutils import escape
 
@@ -158,13 +158,22 @@ def getXYZHPRString(obj):
         -hpr[1]*rad2deg, si[0], si[2], si[1])
     return s
 
-def selectObjectsInList(obj_list):
-    bpy.ops.object.select_all(action='DESELECT')
-    for obj in obj_list:
-        # The objects needs to be in both the active scene and view layer
-        if not obj.select_get() and obj.name in bpy.context.scene.objects and \
-        obj.name in bpy.context.view_layer.objects:
-            obj.select_set(True)
+# The export_spm module of the SPM exporter addon, None if it is not enabled
+def getSPMExporter():
+    cls = bpy.types.Operator.bl_rna_get_subclass_py("SCREEN_OT_spm_export")
+    if cls is None:
+        return None
+    return sys.modules[cls.__module__].export_spm
+
+# Export the objects of obj_list to a SPM file without going through the
+# export operator and the object selection, spm_parameters uses the keys of
+# export_spm.spm_default_parameters, with an export_spm.ExportCache the file
+# is only written if its content changed
+def exportSPM(obj_list, filepath, spm_parameters, export_cache=None, content_hash=None):
+    # The objects needs to be in both the active scene and view layer
+    objects = [obj for obj in dict.fromkeys(obj_list) if obj.name in bpy.context.scene.objects and \
+               obj.name in bpy.context.view_layer.objects]
+    getSPMExporter().exportObjects(objects, filepath, spm_parameters, export_cache, content_hash)
 
 def unhideObjectsTransiently():
     for obj in bpy.data.objects:
@@ -1053,25 +1062,198 @@ def delete_spm(path):
         print("Deleting ", f)
         os.remove(f)
 
+# ------------------------------------------------------------------------------
+# Index of the texture files in texture folders, shared by the kart and track
+# exporters and stored beside the add-on preferences. For every folder it
+# keeps its mtime, its texture file names and its sub folders. A folder is
+# only listed again if its mtime changed (which happens when a file or sub
+# folder is added, removed or renamed in it).
+texture_extensions = ('.png', '.jpeg', '.jpg')
+texture_index = None
+
+def getTextureIndexFile():
+    try:
+        directory = bpy.utils.extension_path_user(__package__, create=True)
+    except (AttributeError, ValueError):
+        directory = bpy.utils.user_resource('CONFIG', path=__package__, create=True)
+    return os.path.join(directory, "stk_texture_index.json")
+
+def loadTextureIndex():
+    global texture_index
+    if texture_index is None:
+        texture_index = {}
+        try:
+            with open(getTextureIndexFile(), "r", encoding="utf8") as f:
+                texture_index = json.load(f)
+        except (OSError, ValueError):
+            pass
+    return texture_index
+
+def saveTextureIndex():
+    try:
+        with open(getTextureIndexFile(), "w", encoding="utf8") as f:
+            json.dump(texture_index, f)
+    except OSError:
+        traceback.print_exc(file=sys.stdout)
+
+# Returns the set of the names of all texture files in dir_tex (recursively)
 def check_texture_name(dir_tex):
-    name_tex = []
-    l_tex = []
-    l_tex += list(dir_tex.glob('**/*.png'))  # check texture PNG
-    l_tex += list(dir_tex.glob('**/*.jpeg'))  # check texture JPG
-    l_tex += list(dir_tex.glob('**/*.jpg'))  # check texture JPEG
-    for textures in l_tex:
-        name_tex.append(pathlib.Path(textures).name)
+    root = os.path.abspath(str(dir_tex))
+    dFolders = loadTextureIndex().get(root, {})
+    dChecked = {}
+    changed = root not in texture_index
+    name_tex = set()
+
+    lFolders = [root]
+    while lFolders:
+        folder = lFolders.pop()
+        if folder in dChecked:
+            continue
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            continue
+
+        entry = dFolders.get(folder)
+        if entry is None or entry[0] != mtime:
+            files = []
+            sub_folders = []
+            try:
+                with os.scandir(folder) as it:
+                    for f in it:
+                        if f.is_dir():
+                            sub_folders.append(f.path)
+                        elif f.name.endswith(texture_extensions):
+                            files.append(f.name)
+            except OSError:
+                continue
+            entry = [mtime, files, sub_folders]
+            changed = True
+
+        dChecked[folder] = entry
+        name_tex.update(entry[1])
+        lFolders.extend(entry[2])
+
+    if changed or len(dChecked) != len(dFolders):
+        texture_index[root] = dChecked
+        saveTextureIndex()
     return name_tex
 
-def copy_texture(path, image, operator):
-    for i, curr in enumerate(bpy.data.images):
+# ------------------------------------------------------------------------------
+# Returns the images used by the materials of the objects of the scene (except
+# objects of type ignore), including the images in node groups, and the
+# images named by a scene, object or material property: sky box, ambient map,
+# screenshot, kart icons and shadow, masks, splatting and layer textures...
+def getReferencedImages(scene):
+    lImages = set()
+    lNodeTrees = []
+    for obj in scene.objects:
+        if getObjectProperty(obj, "type", "").strip().upper() == "IGNORE":
+            continue
+        for slot in obj.material_slots:
+            if slot.material is not None and slot.material.node_tree is not None:
+                lNodeTrees.append(slot.material.node_tree)
+
+    lChecked = set()
+    while lNodeTrees:
+        node_tree = lNodeTrees.pop()
+        if node_tree.as_pointer() in lChecked:
+            continue
+        lChecked.add(node_tree.as_pointer())
+        for node in node_tree.nodes:
+            if node.type == 'TEX_IMAGE' and node.image is not None:
+                lImages.add(node.image)
+            elif node.type == 'GROUP' and node.node_tree is not None:
+                lNodeTrees.append(node.node_tree)
+
+    # The exported xml files refer to textures by file name in string properties
+    lProperties = [scene]
+    lProperties += [obj for obj in scene.objects
+                    if getObjectProperty(obj, "type", "").strip().upper() != "IGNORE"]
+    lProperties += list(bpy.data.materials)
+    lNames = set()
+    for owner in lProperties:
+        for key in owner.keys():
+            if isinstance(owner[key], str) and owner[key]:
+                lNames.add(owner[key].strip())
+                lNames.update(owner[key].split())
+
+    # Default kart icon, minimap icon and shadow names, see exportKart
+    if isinstance(scene.get("name"), str) and scene["name"]:
+        kart_name = scene["name"].lower()
+        lNames.update((kart_name + "_icon.png", kart_name + "_map_icon.png", kart_name + "_shadow.png"))
+
+    for curr in bpy.data.images:
+        if curr.filepath and os.path.basename(bpy.path.abspath(curr.filepath)) in lNames:
+            lImages.add(curr)
+    return lImages
+
+# Copies src to dst unless dst is already the same file: same size and mtime
+# (copies keep the mtime of the source), or same content. With link a hard
+# link is created instead of a copy if possible (same file system). Returns
+# True if the file was copied.
+def copyTextureFile(src, dst, link):
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return False
+        src_stat = os.stat(src)
+        dst_stat = os.stat(dst)
+        if src_stat.st_size == dst_stat.st_size:
+            if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+                return False
+            lHashes = []
+            for sFile in (src, dst):
+                with open(sFile, "rb") as f:
+                    lHashes.append(hashlib.file_digest(f, "blake2b").digest() if hasattr(hashlib, "file_digest")
+                                   else hashlib.blake2b(f.read()).digest())
+            if lHashes[0] == lHashes[1]:
+                # Same content, next time the mtime is enough
+                os.utime(dst, ns=(dst_stat.st_atime_ns, src_stat.st_mtime_ns))
+                return False
+        if link:
+            os.remove(dst)
+
+    if link:
         try:
-            if curr.filepath is None or len(curr.filepath) == 0:
-                continue
-            abs_texture_path = bpy.path.abspath(curr.filepath)  # check texture path
-            if not pathlib.Path(abs_texture_path).name in image:  # check if texture not in STK Projet
-                shutil.copy(abs_texture_path, path)  # copy all texture used in blender file
-                print(f"Copy Texture {abs_texture_path} to {path}")
-        except:
-            traceback.print_exc(file=sys.stdout)
-            operator.report({'WARNING'}, f"Failed to copy texture {curr.filepath}")
\ No newline at end of file
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return True
+
+# Copies the images referenced by the exported scene to path, except the
+# textures already in the STK data (image, see check_texture_name). Files
+# that are already up to date are skipped, the others are copied on a thread
+# pool.
+def copy_texture(path, image, operator):
+    addon = bpy.context.preferences.addons.get(__package__)
+    link = addon is not None and getattr(addon.preferences, "stk_link_images", False)
+
+    dCopies = {}
+    for curr in getReferencedImages(bpy.context.scene):
+        if curr.filepath is None or len(curr.filepath) == 0:
+            continue
+        abs_texture_path = bpy.path.abspath(curr.filepath)  # check texture path
+        name = pathlib.Path(abs_texture_path).name
+        if name in image or name in dCopies:  # check if texture not in STK Projet
+            continue
+        dCopies[name] = (curr.filepath, abs_texture_path, os.path.join(path, name))
+
+    copied = [0, 0]
+    skipped = [0, 0]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+        dFutures = {executor.submit(copyTextureFile, src, dst, link): (filepath, src)
+                    for (filepath, src, dst) in dCopies.values()}
+        for future in concurrent.futures.as_completed(dFutures):
+            (filepath, src) = dFutures[future]
+            try:
+                counter = copied if future.result() else skipped
+                counter[0] += 1
+                counter[1] += os.path.getsize(src)
+            except:
+                traceback.print_exc(file=sys.stdout)
+                operator.report({'WARNING'}, f"Failed to copy texture {filepath}")
+
+    print(f"Copy Texture: {copied[0]} files ({copied[1]} bytes) copied, {skipped[0]} files ({skipped[1]} bytes) up to date in {path}")
+    operator.report({'INFO'}, f"Textures: {copied[0]} copied ({copied[1] / 1048576:.1f} MB), {skipped[0]} up to date ({skipped[1] / 1048576:.1f} MB)")
@@ -94,22 +94,34 @@ class SPM_Export_Operator(bpy.types.Operator, ExportHelper):
        )
     localsp: bpy.props.BoolProperty(name="Use local coordinates", default = False)
     applymodifiers: bpy.props.BoolProperty(name="Apply modifiers", default = True)
+    weld_tolerance: bpy.props.FloatProperty(name="Weld tolerance",
+        description="Vertices closer than this (with identical normal, color, UVs and weights) are merged",
+        default = 0.0001, min = 0.0, precision = 5)
     keyframes_only: bpy.props.BoolProperty(name="Export keyframes only", default = True)
     export_normal: bpy.props.BoolProperty(name="Export normals", default = True)
     export_vcolor: bpy.props.BoolProperty(name="Export vertex colors", default = True)
     export_tangent: bpy.props.BoolProperty(name="Calculate tangent and bitangent signs", default = True)
     static_mesh_frame: bpy.props.IntProperty(name="Frame for static mesh usage", default = -1)
+    sector_size: bpy.props.FloatProperty(name="Sector size",
+        description="Split static meshes into square sectors of this size (space partitioned mesh), 0 to export a single sector",
+        default = 0.0, min = 0.0)
+    optimize_vertex_cache: bpy.props.BoolProperty(name="Optimize vertex cache",
+        description="Reorder triangles and vertices of every mesh buffer for GPU vertex cache and fetch locality (slower export)",
+        default = False)
 
     def execute(self, context):
         spm_parameters = {}
         spm_parameters["selection-type"] = self.selection_type
         spm_parameters["local-space"] = self.localsp
         spm_parameters["apply-modifiers"] = self.applymodifiers
+        spm_parameters["weld-tolerance"] = self.weld_tolerance
         spm_parameters["keyframes-only"] = self.keyframes_only
         spm_parameters["export-normal"] = self.export_normal
         spm_parameters["export-vcolor"] = self.export_vcolor
         spm_parameters["export-tangent"] = self.export_tangent
         spm_parameters["static-mesh-frame"] = self.static_mesh_frame
+        spm_parameters["sector-size"] = self.sector_size
+        spm_parameters["optimize-vertex-cache"] = self.optimize_vertex_cache
 
         print("EXPORT", self.filepath)
         export_spm.writeSPMFile(self.filepath, spm_parameters)
@@ -142,6 +154,9 @@ class SPM_PT_export_mesh(bpy.types.Panel):
         layout.prop(operator, "selection_type")
         layout.prop(operator, "localsp")
         layout.prop(operator, "applymodifiers")
+        layout.prop(operator, "weld_tolerance")
+        layout.prop(operator, "sector_size")
+        layout.prop(operator, "optimize_vertex_cache")
 
 class SPM_PT_export_include(bpy.types.Panel):
     bl_space_type = 'FILE_BROWSER'
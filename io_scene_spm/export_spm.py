@@ -20,10 +20,30 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import bpy, sys, os, struct, math, string, mathutils, bmesh, time
+import bpy, sys, os, struct, math, string, mathutils, bmesh, time, hashlib, json
+import numpy as np
 
 spm_version = 1
 
+# Version of the exporter output, part of the export cache hash and manifest.
+# Bump it whenever a change to the exporter alters the written SPM files, so
+# that files cached by an older exporter are exported again
+spm_exporter_version = 1
+
+# Export parameters used when not given, same as the export operator defaults
+spm_default_parameters = {
+    "local-space": False,
+    "apply-modifiers": True,
+    "weld-tolerance": 0.0001,
+    "keyframes-only": True,
+    "export-normal": True,
+    "export-vcolor": True,
+    "export-tangent": True,
+    "static-mesh-frame": -1,
+    "sector-size": 0.0,
+    "optimize-vertex-cache": False,
+}
+
 def get_fcurves(anim_data):
     if not anim_data:
         return None
@@ -104,6 +124,24 @@ def write2101010Rev(vector3):
     ret |= (part & 3) << 30
     return writeUint(ret)
 
+# Array version of write2101010Rev, returns one uint32 per row
+def pack2101010Rev(vectors):
+    v = np.clip(vectors.astype(np.float64), -1.0, 1.0)
+    part = np.where(v > 0.0, v * 511.0 + 0.5, v * 512.0 - 0.5)
+    if v.shape[1] == 4:
+        part[:, 3] = np.where(v[:, 3] > 0.0, v[:, 3] * 1.0 + 0.5, v[:, 3] * 2.0 - 0.5)
+    part = np.trunc(part).astype(np.int64)
+    ret = part[:, 0] & 1023
+    ret |= (part[:, 1] & 1023) << 10
+    ret |= (part[:, 2] & 1023) << 20
+    if v.shape[1] == 4:
+        ret |= (part[:, 3] & 3) << 30
+    return ret.astype(np.uint32)
+
+# Array version of writeHalfFloat, returns the raw half float bits
+def packHalfFloat(values):
+    return values.astype(np.float16).view(np.uint16)
+
 def writeLenString(value):
     encoded = str.encode(value)
     if len(encoded) > 255:
@@ -200,16 +238,6 @@ def getUniqueFrame(armature, keyframe_only):
         #    print('unique_frame:{} {}'.format(frame, armature.name))
     return unique_frame
 
-def equals(float1, float2):
-    return (float1 + 0.0001 >= float2) and (float1 - 0.0001 <= float2)
-
-def vectorEquals(vec1, vec2):
-    if vec1 is None and vec2 is None:
-        return True
-    if len(vec1) != len(vec2):
-        raise Exception("Vector length is different")
-    return all(equals(v1, v2) for v1, v2 in zip(vec1, vec2))
-
 class ExportArm:
     m_accumulated_bone = 0
     NEW_BONE = 99999999
@@ -226,34 +254,45 @@ class ExportArm:
         self.m_bone_in_use = 0
         self.m_bone_local_id = []
         self.m_bone_names = {}
+        self.m_bone_by_id = {}
         self.m_keyframe_only = keyframe_only
         for pose_bone in arm.pose.bones:
             self.m_bone_names[pose_bone.name] = ExportArm.NEW_BONE
 
-    def buildIndex(self, all_triangles):
+    def buildIndex(self, all_meshes, joints, weights):
         self.m_arm.data.pose_position = 'POSE'
-        for triangle in all_triangles:
-            if triangle.m_armature_name != self.m_arm.data.name:
+        corner_offset = 0
+        for mesh_arrays in all_meshes:
+            corner_count = len(mesh_arrays.m_vertex_index)
+            if mesh_arrays.m_armature_name != self.m_arm.data.name:
+                corner_offset += corner_count
                 continue
-            for vertex in triangle.m_vertices:
-                found = 0
-                for bone_name, weight in vertex.m_bones_weights:
-                    if weight == 0.0:
-                        continue
-                    if found > 3:
-                        break
-                    if bone_name in self.m_bone_names:
-                        if self.m_bone_names[bone_name] == ExportArm.NEW_BONE:
-                            self.m_bone_names[bone_name] = ExportArm.m_accumulated_bone
-                            ExportArm.m_accumulated_bone += 1
-                        vertex.m_joints[found] = self.m_bone_names[bone_name]
-                        vertex.m_weights[found] = weight
-                        found += 1
+            corner_groups = mesh_arrays.m_vertex_groups[mesh_arrays.m_vertex_index]
+            # Bone ids are given in first use order, the extra last entry
+            # keeps -1 (unused joint) mapped to -1
+            group_ids = np.full(len(mesh_arrays.m_group_names) + 1, -1, dtype = np.int64)
+            used_groups, first_use = np.unique(corner_groups, return_index = True)
+            for group in used_groups[np.argsort(first_use)].tolist():
+                if group == -1:
+                    continue
+                bone_name = mesh_arrays.m_group_names[group]
+                if self.m_bone_names[bone_name] == ExportArm.NEW_BONE:
+                    self.m_bone_names[bone_name] = ExportArm.m_accumulated_bone
+                    ExportArm.m_accumulated_bone += 1
+                group_ids[group] = self.m_bone_names[bone_name]
+            joints[corner_offset:corner_offset + corner_count] = group_ids[corner_groups]
+            weights[corner_offset:corner_offset + corner_count] =\
+            mesh_arrays.m_vertex_weights[mesh_arrays.m_vertex_index]
+            corner_offset += corner_count
 
     def buildLocalId(self):
         for k, v in self.m_bone_names.items():
             self.m_bone_local_id.append([k, v])
         self.m_bone_local_id.sort(key = lambda x: x[1])
+        self.m_bone_by_id = {}
+        for k, v in self.m_bone_names.items():
+            if v != ExportArm.NEW_BONE:
+                self.m_bone_by_id[v] = k
         unused_bone = 0
         for bone_tu in self.m_bone_local_id:
             if bone_tu[1] != ExportArm.NEW_BONE:
@@ -267,11 +306,14 @@ class ExportArm:
         #print(self.m_bone_in_use)
         #print(self.m_bone_local_id)
 
-    def getBone(self, bone_id):
-        for k, v in self.m_bone_names.items():
-            if bone_id == v:
-                return self.m_arm.data.bones[k]
-        return None
+    # Store the skinning matrix of every used bone at the current frame into
+    # palette, indexed by the accumulated bone id used in the vertex joints
+    def buildPalette(self, palette):
+        for bone_id, bone_name in self.m_bone_by_id.items():
+            bone = self.m_arm.data.bones[bone_name]
+            pose_bone = self.m_arm.pose.bones[bone_name]
+            bone_inv = bone.matrix_local.inverted_safe() @ self.m_real_inv_matrix
+            palette[bone_id] = np.array(self.m_real_matrix @ pose_bone.matrix @ bone_inv)
 
     def writeArmature(self):
             tmp_buf = bytearray()
@@ -317,124 +359,41 @@ class ExportArm:
             self.m_arm.data.pose_position = self.m_original_pose_position
             return tmp_buf
 
-class Vertex:
-    def __init__(self):
-        self.m_position = None
-        self.m_normal = mathutils.Vector((0.0, 0.0, 1.0)).freeze()
-        self.m_color = (255, 255, 255)
-        self.m_all_uvs = None
-        self.m_tangent = mathutils.Vector((1.0, 0.0, 0.0, 1.0)).freeze()
-        self.m_bones_weights = None
-        self.m_joints = [-1, -1, -1, -1]
-        self.m_weights = [0.0, 0.0, 0.0, 0.0]
-
-    def __hash__(self):
-        def roundTuple(data, decimals = 3):
-            if data is None:
-                return ()
-            return tuple(round(x, decimals) for x in data)
-        return hash((
-            roundTuple(self.m_position),
-            roundTuple(self.m_normal),
-            self.m_color,
-            roundTuple(self.m_all_uvs),
-            self.m_tangent.w,
-            self.m_joints
-        ))
-
-    def __eq__(self, other):
-        if not isinstance(other, Vertex):
-            return NotImplemented
-        return (
-            vectorEquals(self.m_position, other.m_position) and
-            vectorEquals(self.m_normal, other.m_normal) and
-            self.m_color == other.m_color and
-            vectorEquals(self.m_all_uvs, other.m_all_uvs) and
-            vectorEquals(self.m_tangent, other.m_tangent) and
-            self.m_joints == other.m_joints and
-            vectorEquals(self.m_weights, other.m_weights)
-        )
-
-    def writeVertex(self, export_normal, uv_1, uv_2, vcolor, arm_dict, need_export_tangent):
-        tmp_buf = bytearray()
-        joint_matrix = None
-        write_joints = arm_dict is not None
-        if write_joints:
-            for i in range(0, 4):
-                if self.m_joints[i] == -1:
-                    break
-                bone = None
-                for arm in arm_dict.values():
-                    bone = arm.getBone(self.m_joints[i])
-                    if bone is not None:
-                        break
-                pose_bone = arm.m_arm.pose.bones[bone.name]
-                bone_inv = bone.matrix_local.inverted_safe() @ arm.m_real_inv_matrix
-                bone_mat = arm.m_real_matrix @ pose_bone.matrix @ bone_inv
-                if joint_matrix is None:
-                    joint_matrix = bone_mat * self.m_weights[i]
-                else:
-                    joint_matrix += bone_mat * self.m_weights[i]
-        out_vector = self.m_position
-        if joint_matrix is not None:
-            out_vector = joint_matrix @ self.m_position.to_4d()
-        for i in [0, 2, 1]:
-            tmp_buf += writeFloat(out_vector[i])
-        if export_normal:
-            out_vector = self.m_normal
-            if joint_matrix is not None:
-                out_vector = self.m_normal.to_4d()
-                out_vector.w = 0.0
-                out_vector = joint_matrix @ out_vector
-                out_vector.normalize()
-            tmp_buf += write2101010Rev(out_vector.xzy)
-        if vcolor:
-            if self.m_color[0] == 255 and self.m_color[1] == 255 and\
-            self.m_color[2] == 255:
-                tmp_buf += writeUint8(128)
-            else:
-                tmp_buf += writeUint8(255)
-                tmp_buf += writeUint8(self.m_color[0])
-                tmp_buf += writeUint8(self.m_color[1])
-                tmp_buf += writeUint8(self.m_color[2])
-        if uv_1:
-            tmp_buf += writeHalfFloat(self.m_all_uvs[0])
-            tmp_buf += writeHalfFloat(self.m_all_uvs[1])
-            if uv_2:
-                tmp_buf += writeHalfFloat(self.m_all_uvs[2])
-                tmp_buf += writeHalfFloat(self.m_all_uvs[3])
-            if need_export_tangent:
-                out_vector = self.m_tangent
-                if joint_matrix is not None:
-                    out_vector = self.m_tangent.copy()
-                    out_vector.w = 0.0
-                    out_vector = joint_matrix @ out_vector
-                    out_vector.normalize()
-                    out_vector.w = self.m_tangent.w
-                tmp_buf += write2101010Rev(out_vector.xzyw)
-        if write_joints:
-            tmp_buf += writeInt16(self.m_joints[0])
-            tmp_buf += writeInt16(self.m_joints[1])
-            tmp_buf += writeInt16(self.m_joints[2])
-            tmp_buf += writeInt16(self.m_joints[3])
-            tmp_buf += writeHalfFloat(self.m_weights[0])
-            tmp_buf += writeHalfFloat(self.m_weights[1])
-            tmp_buf += writeHalfFloat(self.m_weights[2])
-            tmp_buf += writeHalfFloat(self.m_weights[3])
-        return tmp_buf
-
-class Triangle:
-    def __init__(self):
-        self.m_vertices = None
-        self.m_texture_one = None
-        self.m_texture_two = None
-        self.m_texture_cmp = None
-        self.m_armature_name = None
-
-    def removeJointsData(self):
-        for v in self.m_vertices:
-            v.m_joints = None
-            v.m_weights = None
+# Skinning matrices of all armatures at the current frame, indexed by the
+# accumulated bone id
+def buildSkinningPalette(arm_dict):
+    palette = np.zeros((max(1, ExportArm.m_accumulated_bone), 4, 4), dtype = np.float64)
+    for arm in arm_dict.values():
+        arm.buildPalette(palette)
+    return palette
+
+# Linear blend skinning of a batch of vertices, updates positions, normals
+# and tangents in place, vertices without any joint are left untouched
+def skinVertices(palette, positions, normals, tangents, joints, weights):
+    skinned = np.flatnonzero(joints[:, 0] != -1)
+    if len(skinned) == 0:
+        return
+    used_joints = joints[skinned]
+    used_weights = np.where(used_joints != -1, weights[skinned], 0.0)
+    joint_matrix = np.einsum('vj,vjab->vab', used_weights,
+        palette[np.maximum(used_joints, 0)])
+
+    def transform(vectors, w):
+        out_vector = np.empty((len(vectors), 4), dtype = np.float64)
+        out_vector[:, 0:3] = vectors
+        out_vector[:, 3] = w
+        return np.einsum('vab,vb->va', joint_matrix, out_vector)
+
+    def normalized(vectors):
+        length = np.sqrt(np.einsum('va,va->v', vectors, vectors))
+        length[length == 0.0] = np.inf
+        return vectors / length[:, None]
+
+    positions[skinned] = transform(positions[skinned], 1.0)[:, 0:3]
+    if normals is not None:
+        normals[skinned] = normalized(transform(normals[skinned], 0.0))[:, 0:3]
+    if tangents is not None:
+        tangents[skinned, 0:3] = normalized(transform(tangents[skinned, 0:3], 0.0))[:, 0:3]
 
 def searchMaterialForImage(material, uv_num):
     # Check if there is a material
@@ -467,29 +426,596 @@ def searchMaterialForImage(material, uv_num):
     else:
         return ""
 
+# Texture names used by the triangles of obj with material_index, the
+# search only depends on the material so it is done once per export and
+# kept in material_cache
+def getMaterialTextures(obj, material_index, has_uv_two, material_cache):
+    def search(material, uv_num):
+        key = (material, uv_num)
+        if key not in material_cache:
+            material_cache[key] = searchMaterialForImage(material, uv_num)
+        return material_cache[key]
+
+    if material_index < 0 or not obj.material_slots:
+        texture_one = ""
+    elif material_index < len(obj.material_slots):
+        texture_one = search(obj.material_slots[material_index].material, 1)
+    else:
+        texture_one = search(obj.material_slots[-1].material, 1)
+
+    if obj.material_slots and has_uv_two:
+        texture_two = search(obj.material_slots[-1].material, 2)
+    else:
+        texture_two = ""
+    return (texture_one, texture_two)
+
+# ==== Mesh Extraction ====
+# Same result as mathutils.Vector.normalized() for a batch of float vectors:
+# float products summed in double starting from the last component, then a
+# float reciprocal of the length
+def normalizeVectors(vectors):
+    squared = vectors * vectors
+    length = np.zeros(len(vectors), dtype = np.float64)
+    for i in reversed(range(0, vectors.shape[1])):
+        length += squared[:, i]
+    valid = length > 1.0e-35
+    scale = np.zeros(len(vectors), dtype = np.float32)
+    scale[valid] = np.float32(1.0) / np.sqrt(length[valid]).astype(np.float32)
+    return vectors * scale[:, None]
+
+# Per triangle corner data of a mesh, pulled in bulk with foreach_get
+# Every corner array has 3 rows per loop triangle, in the order of
+# loop_triangles[].loops
+class MeshArrays:
+    def __init__(self, mesh, export_normal, export_tangent, export_vcolor):
+        mesh.calc_loop_triangles()
+        triangle_count = len(mesh.loop_triangles)
+        loop_count = len(mesh.loops)
+
+        loops = np.empty(triangle_count * 3, dtype = np.int32)
+        mesh.loop_triangles.foreach_get("loops", loops)
+        self.m_material_index = np.empty(triangle_count, dtype = np.int32)
+        mesh.loop_triangles.foreach_get("material_index", self.m_material_index)
+
+        loop_vertex = np.empty(loop_count, dtype = np.int32)
+        mesh.loops.foreach_get("vertex_index", loop_vertex)
+        self.m_vertex_index = loop_vertex[loops]
+
+        co = np.empty(len(mesh.vertices) * 3, dtype = np.float32)
+        mesh.vertices.foreach_get("co", co)
+        self.m_positions = co.reshape(-1, 3)[self.m_vertex_index]
+
+        self.m_normals = None
+        if export_normal:
+            normal = np.empty(len(mesh.vertices) * 3, dtype = np.float32)
+            mesh.vertices.foreach_get("normal", normal)
+            self.m_normals = normalizeVectors(normal.reshape(-1, 3))[self.m_vertex_index]
+
+        # V is flipped in double precision, like the per-loop code did
+        self.m_uvs = np.zeros((triangle_count * 3, 4), dtype = np.float64)
+        for layer_id in range(0, min(2, len(mesh.uv_layers))):
+            uv = np.empty(loop_count * 2, dtype = np.float32)
+            mesh.uv_layers[layer_id].data.foreach_get("uv", uv)
+            uv = uv.reshape(-1, 2)[loops]
+            self.m_uvs[:, layer_id * 2] = uv[:, 0]
+            self.m_uvs[:, layer_id * 2 + 1] = 1.0 - uv[:, 1].astype(np.float64)
+
+        self.m_colors = None
+        if export_vcolor:
+            color = np.empty(loop_count * 4, dtype = np.float32)
+            mesh.vertex_colors[0].data.foreach_get("color", color)
+            color = color.reshape(-1, 4)[loops, :3]
+            self.m_colors = np.minimum(color * np.float64(255.0), 255.0).astype(np.uint8)
+
+        self.m_tangents = None
+        if export_tangent:
+            tangent = np.empty(loop_count * 3, dtype = np.float32)
+            mesh.loops.foreach_get("tangent", tangent)
+            bitangent_sign = np.empty(loop_count, dtype = np.float32)
+            mesh.loops.foreach_get("bitangent_sign", bitangent_sign)
+            self.m_tangents = np.empty((triangle_count * 3, 4), dtype = np.float32)
+            self.m_tangents[:, :3] = normalizeVectors(tangent.reshape(-1, 3))[loops]
+            self.m_tangents[:, 3] = -bitangent_sign[loops]
+
+        # Filled by writeSPMFile, per triangle index in the exported
+        # (texture_one, texture_two) list
+        self.m_material_id = None
+        self.m_armature_name = None
+        # Filled by extractWeights, per mesh vertex
+        self.m_group_names = None
+        self.m_vertex_groups = None
+        self.m_vertex_weights = None
+
+    def getBoundingBox(self):
+        return self.m_positions.min(axis = 0), self.m_positions.max(axis = 0)
+
+    # Read all vertex group weights in one sweep into a sparse (vertex,
+    # group, weight) matrix, then keep the 4 heaviest groups that match a bone
+    # of bone_names for every vertex and normalize them
+    def extractWeights(self, mesh, obj, bone_names):
+        vertex_count = len(mesh.vertices)
+        self.m_group_names = [group.name for group in obj.vertex_groups]
+        entries = [(vi, group.group, group.weight)
+            for vi, vertex in enumerate(mesh.vertices) for group in vertex.groups]
+        entries = np.array(entries, dtype = np.float64).reshape(-1, 3)
+        vertex = entries[:, 0].astype(np.int64)
+        group = entries[:, 1].astype(np.int64)
+        weight = entries[:, 2]
+
+        is_bone = np.array([name in bone_names for name in self.m_group_names] + [False])
+        group[(group < 0) | (group >= len(self.m_group_names))] = -1
+        keep = is_bone[group] & (weight != 0.0)
+        entry_id = np.flatnonzero(keep)
+        vertex = vertex[keep]
+        group = group[keep]
+        weight = weight[keep]
+
+        # Heaviest first, same weights keep the vertex group order
+        order = np.lexsort((entry_id, -weight, vertex))
+        vertex = vertex[order]
+        group = group[order]
+        weight = weight[order]
+        rank = np.arange(len(vertex)) - np.searchsorted(vertex, vertex)
+        top = rank < 4
+
+        self.m_vertex_groups = np.full((vertex_count, 4), -1, dtype = np.int64)
+        self.m_vertex_weights = np.zeros((vertex_count, 4), dtype = np.float64)
+        self.m_vertex_groups[vertex[top], rank[top]] = group[top]
+        self.m_vertex_weights[vertex[top], rank[top]] = weight[top]
+        total_weights = self.m_vertex_weights[:, 0] + self.m_vertex_weights[:, 1] +\
+        self.m_vertex_weights[:, 2] + self.m_vertex_weights[:, 3]
+        weighted = total_weights > 0.0
+        self.m_vertex_weights[weighted] /= total_weights[weighted, None]
+
+# Concatenate a corner array of all meshes, meshes without it use default.
+# The array of each mesh is dropped as soon as it is copied, so that the
+# corner data is never held twice
+def concatenateCorners(all_meshes, name, default, dtype):
+    corner_count = sum(len(mesh_arrays.m_vertex_index) for mesh_arrays in all_meshes)
+    result = np.empty((corner_count, len(default)), dtype = dtype)
+    start = 0
+    for mesh_arrays in all_meshes:
+        end = start + len(mesh_arrays.m_vertex_index)
+        array = getattr(mesh_arrays, name)
+        result[start:end] = default if array is None else array
+        setattr(mesh_arrays, name, None)
+        start = end
+    return result
+
+# ==== Vertex Welding ====
+# One fixed width key per corner, built from the quantized position and the
+# packed form of every other written field, corners with the same key are
+# written as the same vertex
+def buildWeldKeys(positions, packed_columns, tolerance):
+    if tolerance > 0.0:
+        columns = [np.floor(positions.astype(np.float64) / tolerance + 0.5).astype(np.int64)]
+    else:
+        # + 0.0 so that -0.0 and 0.0 share the same bits
+        columns = [(positions + np.float32(0.0)).view(np.int32).astype(np.int64)]
+    for packed in packed_columns:
+        columns.append(packed.reshape(len(positions), -1).astype(np.int64))
+    keys = np.ascontiguousarray(np.concatenate(columns, axis = 1))
+    return keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+
+# Weld the corners of one material (already in written order, 3 per
+# triangle) and split them into mesh buffers, like the old exporter a new
+# buffer is started once the current one holds more than max_vertices
+# Returns a list of (corner used for each vertex, index buffer)
+def weldMeshBuffers(keys, max_vertices = 65532):
+    corner_count = len(keys)
+    weld_id = np.unique(keys, return_inverse = True)[1].ravel()
+
+    # Previous corner welded to the same vertex, -1 if none
+    order = np.argsort(weld_id, kind = 'stable')
+    previous = np.full(corner_count, -1, dtype = np.int64)
+    same = weld_id[order[1:]] == weld_id[order[:-1]]
+    previous[order[1:][same]] = order[:-1][same]
+
+    mesh_buffers = []
+    start = 0
+    while start < corner_count:
+        end = corner_count
+        window = 3 * (max_vertices + 1)
+        while True:
+            window_end = min(corner_count, start + window)
+            new_vertices = (previous[start:window_end] < start).reshape(-1, 3).sum(axis = 1)
+            overflow = np.flatnonzero(np.cumsum(new_vertices) > max_vertices)
+            if len(overflow) > 0:
+                end = start + (int(overflow[0]) + 1) * 3
+                break
+            if window_end == corner_count:
+                break
+            window *= 2
+
+        # Vertices are numbered in first use order
+        vertex_corners, indices = firstUseOrder(weld_id[start:end])
+        mesh_buffers.append((start + vertex_corners, indices))
+        start = end
+    return mesh_buffers
+
+# Number the distinct values of ids in the order they are first used,
+# returns the position of the first use of each value and the new ids
+def firstUseOrder(ids):
+    first_use, local_id = np.unique(ids, return_index = True,
+        return_inverse = True)[1:]
+    first_order = np.argsort(first_use)
+    remap = np.empty(len(first_use), dtype = np.int64)
+    remap[first_order] = np.arange(len(first_use))
+    return first_use[first_order], remap[local_id.ravel()]
+
+# ==== Vertex Cache Optimization ====
+# Triangle order for post-transform vertex cache locality, using the vertex
+# scores of Tom Forsyth's linear-speed vertex cache optimisation with a
+# simulated LRU cache of cache_size entries
+def optimizeVertexCache(indices, vertex_count, cache_size = 16):
+    triangle_count = len(indices) // 3
+    if triangle_count == 0:
+        return np.arange(0)
+
+    # Score of a vertex by cache position (cache_size if not cached) and by
+    # the number of not yet written triangles using it
+    cache_scores = [0.75] * 3 + [(1.0 - (p - 3) / (cache_size - 3)) ** 1.5
+        for p in range(3, cache_size)] + [0.0]
+    valence_scores = [-1.0] + [2.0 * (valence ** -0.5) for valence in range(1, 33)]
+
+    # Triangles of every vertex, written triangles are moved past live[v]
+    valence = np.bincount(indices, minlength = vertex_count)
+    offsets = np.concatenate(([0], np.cumsum(valence)[:-1])).tolist()
+    adjacency = (np.argsort(indices, kind = 'stable') // 3).tolist()
+    live = valence.tolist()
+    vertex_scores = [valence_scores[min(n, 32)] for n in live]
+    triangles = indices.reshape(-1, 3).tolist()
+    triangle_scores = [vertex_scores[a] + vertex_scores[b] + vertex_scores[c]
+        for a, b, c in triangles]
+    written = bytearray(triangle_count)
+
+    cache = []
+    triangle_order = []
+    next_unwritten = 0
+    current = max(range(triangle_count), key = triangle_scores.__getitem__)
+    while current >= 0:
+        triangle_order.append(current)
+        written[current] = 1
+        triangle = triangles[current]
+        for v in triangle:
+            start = offsets[v]
+            last = start + live[v] - 1
+            for k in range(start, last + 1):
+                if adjacency[k] == current:
+                    adjacency[k] = adjacency[last]
+                    adjacency[last] = current
+                    break
+            live[v] -= 1
+
+        new_cache = triangle + [v for v in cache if v not in triangle]
+        for position, v in enumerate(new_cache):
+            n = live[v]
+            score = cache_scores[min(position, cache_size)] + valence_scores[min(n, 32)]\
+                if n > 0 else -1.0
+            change = score - vertex_scores[v]
+            vertex_scores[v] = score
+            start = offsets[v]
+            for k in range(start, start + n):
+                triangle_scores[adjacency[k]] += change
+        cache = new_cache[:cache_size]
+
+        # Best triangle using a cached vertex, else the next unwritten one
+        current = -1
+        best_score = -1.0
+        for v in cache:
+            start = offsets[v]
+            for k in range(start, start + live[v]):
+                t = adjacency[k]
+                if triangle_scores[t] > best_score:
+                    current = t
+                    best_score = triangle_scores[t]
+        if current < 0:
+            while next_unwritten < triangle_count and written[next_unwritten]:
+                next_unwritten += 1
+            if next_unwritten < triangle_count:
+                current = next_unwritten
+    return np.array(triangle_order, dtype = np.int64)
+
+# Vertex cache misses of indices with a FIFO cache of cache_size entries,
+# divided by the triangle count this is the ACMR (average cache miss ratio)
+def countCacheMisses(indices, vertex_count, cache_size = 16):
+    misses = 0
+    inserted = [-cache_size] * vertex_count
+    for v in indices.tolist():
+        if misses - inserted[v] >= cache_size:
+            inserted[v] = misses
+            misses += 1
+    return misses
+
+# ==== Vertex Encoding ====
+# Packed structured dtype of one mesh buffer vertex, vertex color is stored
+# as 4 bytes here and shrunk to 1 byte for white vertices by encodeVertices
+def getVertexDtype(normal, vcolor, uv_1, uv_2, tangent, joints):
+    fields = [("position", "<f4", (3,))]
+    if normal:
+        fields.append(("normal", "<u4"))
+    if vcolor:
+        fields.append(("color", "u1", (4,)))
+    if uv_1:
+        fields.append(("uv_one", "<f2", (2,)))
+        if uv_2:
+            fields.append(("uv_two", "<f2", (2,)))
+        if tangent:
+            fields.append(("tangent", "<u4"))
+    if joints:
+        fields.append(("joints", "<i2", (4,)))
+        fields.append(("weights", "<f2", (4,)))
+    return np.dtype(fields)
+
+# Encode the vertices of a mesh buffer, any of the optional arrays can be
+# None when the buffer does not store it
+def encodeVertices(positions, normals, colors, uvs, tangents, joints, weights):
+    uv_1 = uvs is not None
+    uv_2 = uv_1 and uvs.shape[1] == 4
+    vertex_dtype = getVertexDtype(normals is not None, colors is not None, uv_1,
+        uv_2, tangents is not None, joints is not None)
+    vertices = np.zeros(len(positions), dtype = vertex_dtype)
+    vertices["position"] = positions[:, [0, 2, 1]]
+    if normals is not None:
+        vertices["normal"] = pack2101010Rev(normals[:, [0, 2, 1]])
+    if uv_1:
+        vertices["uv_one"] = uvs[:, 0:2]
+        if uv_2:
+            vertices["uv_two"] = uvs[:, 2:4]
+        if tangents is not None:
+            vertices["tangent"] = pack2101010Rev(tangents[:, [0, 2, 1, 3]])
+    if joints is not None:
+        vertices["joints"] = joints
+        vertices["weights"] = weights
+    if colors is None:
+        return vertices.tobytes()
+
+    # 128: all white, 255: followed by r, g, b
+    white = np.all(colors == 255, axis = 1)
+    vertices["color"][:, 0] = np.where(white, 128, 255)
+    vertices["color"][:, 1:4] = colors
+    keep = np.ones((len(vertices), vertex_dtype.itemsize), dtype = bool)
+    color_offset = vertex_dtype.fields["color"][1]
+    keep[white, color_offset + 1:color_offset + 4] = False
+    return vertices.view(np.uint8).reshape(len(vertices), -1)[keep].tobytes()
+
+# Encode an index buffer, 8 bit indices are enough up to 255 vertices
+def encodeIndices(indices, vertex_count):
+    if vertex_count > 255:
+        return indices.astype("<u2").tobytes()
+    return indices.astype("u1").tobytes()
+
+# ==== Space Partitioning ====
+# Sector of every triangle for SPMS output, from a uniform grid over the
+# ground plane (blender x / y) with square cells of sector_size, sectors are
+# numbered in row order and empty cells are skipped
+def partitionTriangles(positions, sector_size):
+    centroids = positions.reshape(-1, 3, 3).mean(axis = 1)[:, 0:2]
+    cell = np.floor((centroids - centroids.min(axis = 0)) / sector_size).astype(np.int64)
+    cell_id = cell[:, 1] * (cell[:, 0].max() + 1) + cell[:, 0]
+    return np.unique(cell_id, return_inverse = True)[1].ravel()
+
+# ==== Mesh Buffer Writing ====
+# Welds, encodes and writes the mesh buffers of one material straight to the
+# file, so that at most one encoded mesh buffer is held in memory
+class MeshBufferWriter:
+    def __init__(self, spm, positions, normals, vcolors, all_uvs, tangents,
+                 joints, weights, palette, weld_tolerance, optimize_vertex_cache):
+        self.m_spm = spm
+        self.m_positions = positions
+        self.m_normals = normals
+        self.m_vcolors = vcolors
+        self.m_all_uvs = all_uvs
+        self.m_tangents = tangents
+        self.m_joints = joints
+        self.m_weights = weights
+        self.m_palette = palette
+        self.m_weld_tolerance = weld_tolerance
+        self.m_optimize_vertex_cache = optimize_vertex_cache
+        self.m_triangle_count = 0
+        self.m_cache_misses_before = 0
+        self.m_cache_misses_after = 0
+
+    # Write the triangles of material_id (with uv_1 / uv_2 telling which
+    # uv layers the material uses), returns the number of mesh buffers
+    def writeMaterial(self, material_id, triangles, uv_1, uv_2):
+        # Triangles are written in reversed winding order
+        corners = (triangles[:, None] * 3 + [2, 1, 0]).ravel()
+        export_normal = self.m_normals is not None
+        export_vcolor = self.m_vcolors is not None
+        need_export_tangent = uv_1 and self.m_tangents is not None
+        skinned = self.m_joints is not None
+
+        packed_columns = []
+        if export_normal:
+            packed_columns.append(pack2101010Rev(self.m_normals[corners]))
+        if export_vcolor:
+            packed_columns.append(self.m_vcolors[corners])
+        if uv_1:
+            packed_columns.append(packHalfFloat(self.m_all_uvs[corners, 0:2]))
+            if uv_2:
+                packed_columns.append(packHalfFloat(self.m_all_uvs[corners, 2:4]))
+            if need_export_tangent:
+                packed_columns.append(pack2101010Rev(self.m_tangents[corners]))
+        if skinned:
+            packed_columns.append(self.m_joints[corners])
+            packed_columns.append(packHalfFloat(self.m_weights[corners]))
+        keys = buildWeldKeys(self.m_positions[corners], packed_columns, self.m_weld_tolerance)
+
+        mesh_buffer_count = 0
+        for vertex_corners, indices in weldMeshBuffers(keys):
+            vertex_corners = corners[vertex_corners]
+            #print(len(vertex_corners))
+            #print(len(indices))
+            assert len(vertex_corners) < 65536
+            if self.m_optimize_vertex_cache:
+                self.m_triangle_count += len(indices) // 3
+                self.m_cache_misses_before += countCacheMisses(indices, len(vertex_corners))
+                triangle_order = optimizeVertexCache(indices, len(vertex_corners))
+                indices = indices.reshape(-1, 3)[triangle_order].ravel()
+                # Vertices are renumbered in first use order for fetch locality
+                first_use, new_indices = firstUseOrder(indices)
+                vertex_corners = vertex_corners[indices[first_use]]
+                indices = new_indices
+                self.m_cache_misses_after += countCacheMisses(indices, len(vertex_corners))
+            out_positions = self.m_positions[vertex_corners]
+            out_normals = self.m_normals[vertex_corners] if export_normal else None
+            out_tangents = self.m_tangents[vertex_corners] if need_export_tangent else None
+            out_joints = None
+            out_weights = None
+            if skinned:
+                out_joints = self.m_joints[vertex_corners]
+                out_weights = self.m_weights[vertex_corners]
+                skinVertices(self.m_palette, out_positions, out_normals, out_tangents,
+                    out_joints, out_weights)
+
+            self.m_spm.write(writeUint(len(vertex_corners)))
+            self.m_spm.write(writeUint(len(indices)))
+            self.m_spm.write(writeUint16(material_id))
+            self.m_spm.write(encodeVertices(out_positions, out_normals,
+                self.m_vcolors[vertex_corners] if export_vcolor else None,
+                (self.m_all_uvs[vertex_corners] if uv_2 else self.m_all_uvs[vertex_corners, 0:2])\
+                if uv_1 else None, out_tangents, out_joints, out_weights))
+            self.m_spm.write(encodeIndices(indices, len(vertex_corners)))
+            mesh_buffer_count += 1
+        return mesh_buffer_count
+
+# ==== Export Cache ====
+# Hash of everything an exported SPM file depends on: evaluated mesh data,
+# transform, material textures and export parameters. Returns None when the
+# objects cannot be cached (skinned meshes also depend on their animation)
+def hashObjects(exp_obj, spm_parameters):
+    spm_parameters = {**spm_default_parameters, **spm_parameters}
+    spm_parameters.pop("selection-type", None)
+    content_hash = hashlib.blake2b(digest_size = 16)
+    content_hash.update(json.dumps([spm_version, spm_exporter_version, sorted(spm_parameters.items())]).encode())
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    for obj in exp_obj:
+        if obj.type != "MESH":
+            continue
+        if obj.find_armature() is not None:
+            return None
+
+        if not spm_parameters["local-space"]:
+            content_hash.update(np.array(obj.matrix_world, dtype = np.float32).tobytes())
+        for slot in obj.material_slots:
+            content_hash.update(json.dumps([slot.material.name if slot.material else "",
+                searchMaterialForImage(slot.material, 1),
+                searchMaterialForImage(slot.material, 2)]).encode())
+
+        mesh_owner = obj.evaluated_get(depsgraph) if spm_parameters["apply-modifiers"] else obj
+        mesh = mesh_owner.to_mesh()
+        for collection, attribute, width, dtype in (
+            (mesh.vertices, "co", 3, np.float32),
+            (mesh.vertices, "normal", 3, np.float32),
+            (mesh.loops, "vertex_index", 1, np.int32),
+            (mesh.polygons, "loop_total", 1, np.int32),
+            (mesh.polygons, "material_index", 1, np.int32)):
+            data = np.empty(len(collection) * width, dtype = dtype)
+            collection.foreach_get(attribute, data)
+            content_hash.update(data.tobytes())
+        layers = [(layer, "uv", 2) for layer in list(mesh.uv_layers)[0:2]]
+        layers += [(layer, "color", 4) for layer in list(mesh.vertex_colors)[0:1]]
+        for layer, attribute, width in layers:
+            data = np.empty(len(mesh.loops) * width, dtype = np.float32)
+            layer.data.foreach_get(attribute, data)
+            content_hash.update(data.tobytes())
+        mesh_owner.to_mesh_clear()
+    return content_hash.hexdigest()
+
+# Manifest of the SPM files exported to a directory with the hash of their
+# content, so that unchanged files are not exported again in later runs
+class ExportCache:
+    def __init__(self, directory):
+        self.m_path = os.path.join(directory, "spm_export_cache.json")
+        self.m_files = {}
+        self.m_skipped = 0
+        self.m_exported = 0
+        try:
+            with open(self.m_path, "r") as manifest:
+                content = json.load(manifest)
+            if content.get("version") == spm_version and \
+               content.get("exporter_version") == spm_exporter_version:
+                self.m_files = content["files"]
+        except (OSError, ValueError, KeyError):
+            self.m_files = {}
+
+    # True if filename was exported from the same content_hash and is
+    # still there untouched
+    def isUpToDate(self, filename, content_hash):
+        entry = self.m_files.get(os.path.basename(filename))
+        if content_hash is None or entry is None or entry["hash"] != content_hash:
+            return False
+        try:
+            return os.path.getsize(filename) == entry["size"]
+        except OSError:
+            return False
+
+    def record(self, filename, content_hash, seconds):
+        if content_hash is None:
+            self.m_files.pop(os.path.basename(filename), None)
+            return
+        self.m_files[os.path.basename(filename)] = {"hash": content_hash,
+            "size": os.path.getsize(filename), "seconds": round(seconds, 3)}
+
+    def save(self):
+        with open(self.m_path, "w") as manifest:
+            json.dump({"version": spm_version, "exporter_version": spm_exporter_version,
+                "files": self.m_files}, manifest,
+                indent = 1, sort_keys = True)
+        print("SPM export cache: {} exported, {} unchanged".format(self.m_exported, self.m_skipped))
+
 # ==== Write SPM File ====
-# (main exporter function)
+# (export operator entry point, exports the objects of selection-type)
 def writeSPMFile(filename, spm_parameters={}):
-    bounding_boxes = None
-    start = time.time()
-
     if spm_parameters.get("selection-type") == "selected":
         exp_obj = bpy.context.selected_objects
     elif spm_parameters.get("selection-type") == "scene":
         exp_obj = bpy.context.scene.objects
     elif spm_parameters.get("selection-type") == "view-layer":
-        exp_obj = bpy.view_layer.objects
+        exp_obj = bpy.context.view_layer.objects
     else:
         exp_obj = bpy.data.objects
+    exportObjects(exp_obj, filename, spm_parameters)
+
+# (main exporter function, can be called directly by other addons with an
+# explicit object list, parameters not given use spm_default_parameters,
+# with an export_cache unchanged files are skipped, content_hash can be
+# given if hashObjects was already called for the same objects)
+def exportObjects(exp_obj, filename, spm_parameters={}, export_cache=None, content_hash=None):
+    if export_cache is not None:
+        start = time.time()
+        if content_hash is None:
+            content_hash = hashObjects(exp_obj, spm_parameters)
+        if export_cache.isUpToDate(filename, content_hash):
+            export_cache.m_skipped += 1
+            print("Unchanged", filename)
+            return
+        writeObjects(exp_obj, filename, spm_parameters)
+        export_cache.m_exported += 1
+        export_cache.record(filename, content_hash, time.time() - start)
+    else:
+        writeObjects(exp_obj, filename, spm_parameters)
+
+def writeObjects(exp_obj, filename, spm_parameters):
+    bounding_boxes = None
+    start = time.time()
+    spm_parameters = {**spm_default_parameters, **spm_parameters}
 
     has_vertex_color = False
     export_normal = spm_parameters.get("export-normal")
     need_export_tangent = spm_parameters.get("export-tangent")
     if need_export_tangent:
         export_normal = True
+    weld_tolerance = spm_parameters.get("weld-tolerance", 0.0001)
+    sector_size = spm_parameters.get("sector-size", 0.0)
+    optimize_vertex_cache = spm_parameters.get("optimize-vertex-cache", False)
     arm_count = 0
     arm_dict = {}
-    all_triangles = []
+    all_meshes = []
+    material_cache = {}
+    material_ids = {}
+    texture_pairs = []
     static_mesh_frame = spm_parameters.get("static-mesh-frame")\
     if spm_parameters.get("static-mesh-frame") > 0 else bpy.context.scene.frame_start
     if static_mesh_frame < 1:
@@ -516,11 +1042,13 @@ def writeSPMFile(filename, spm_parameters={}):
 
         arm = obj.find_armature()
         if spm_parameters.get("apply-modifiers"):
-            mesh = obj.evaluated_get(bpy.context.evaluated_depsgraph_get()).to_mesh()
+            mesh_owner = obj.evaluated_get(bpy.context.evaluated_depsgraph_get())
         else:
-            mesh = obj.to_mesh()
+            mesh_owner = obj
+        mesh = mesh_owner.to_mesh()
         if len(mesh.vertices) < 1:
             print('{} has no vertices, please check it'.format(obj.name))
+            mesh_owner.to_mesh_clear()
             continue
 
         bm = bmesh.new()
@@ -533,6 +1061,7 @@ def writeSPMFile(filename, spm_parameters={}):
 
         if len(mesh.polygons) < 1:
             print('{} has no faces, please check it'.format(obj.name))
+            mesh_owner.to_mesh_clear()
             continue
 
         if need_export_tangent:
@@ -547,233 +1076,201 @@ def writeSPMFile(filename, spm_parameters={}):
                 no_tangents = True
                 print('{} has no uvmap to calculate tangents'.format(obj.name))
 
-        uv_one = mesh.uv_layers[0] if (len(mesh.uv_layers) >= 1) else None
         uv_two = mesh.uv_layers[1] if (len(mesh.uv_layers) >= 2) else None
 
         colors = mesh.vertex_colors[0] if (len(mesh.vertex_colors) >= 1) else None
         if colors:
             has_vertex_color = True
 
-        mesh.calc_loop_triangles()
-        for f in mesh.loop_triangles:
-            if f.material_index < 0 or not obj.material_slots:
-                texture_one = ""
-            elif f.material_index < len(obj.material_slots):
-                texture_one = searchMaterialForImage(obj.material_slots[f.material_index].material, 1)
-            else:
-                texture_one = searchMaterialForImage(obj.material_slots[-1].material, 1)
+        mesh_arrays = MeshArrays(mesh, export_normal,
+            need_export_tangent and not no_tangents, colors is not None)
 
-            if obj.material_slots and uv_two:
-                texture_two = searchMaterialForImage(obj.material_slots[-1].material, 2)
-            else:
-                texture_two = ""
-
-            texture_cmp = ''.join([texture_one, texture_two])
-            spm_vertices = []
-            for li in f.loops:
-                v = mesh.loops[li].vertex_index
-                vertices = mathutils.Vector(mesh.vertices[v].co).freeze()
-                if bounding_boxes is None:
-                    bounding_boxes = [0] * 6
-                    bounding_boxes[0] = vertices[0]
-                    bounding_boxes[1] = vertices[2]
-                    bounding_boxes[2] = vertices[1]
-                    bounding_boxes[3] = vertices[0]
-                    bounding_boxes[4] = vertices[2]
-                    bounding_boxes[5] = vertices[1]
-                else:
-                    # Min edge
-                    if bounding_boxes[0] > vertices[0]:
-                        bounding_boxes[0] = vertices[0]
-                    if bounding_boxes[1] > vertices[2]:
-                        bounding_boxes[1] = vertices[2]
-                    if bounding_boxes[2] > vertices[1]:
-                        bounding_boxes[2] = vertices[1]
-                    # Max edge
-                    if bounding_boxes[3] < vertices[0]:
-                        bounding_boxes[3] = vertices[0]
-                    if bounding_boxes[4] < vertices[2]:
-                        bounding_boxes[4] = vertices[2]
-                    if bounding_boxes[5] < vertices[1]:
-                        bounding_boxes[5] = vertices[1]
-
-                all_uvs = [0.0, 0.0, 0.0, 0.0]
-                if uv_one:
-                    all_uvs[0] = uv_one.data[li].uv[0]
-                    all_uvs[1] = 1.0 - uv_one.data[li].uv[1]
-                if uv_two:
-                    all_uvs[2] = uv_two.data[li].uv[0]
-                    all_uvs[3] = 1.0 - uv_two.data[li].uv[1]
-                all_uvs = tuple(all_uvs)
-
-                each_joint_data = []
-                if arm_count != 0:
-                    for group in mesh.vertices[v].groups:
-                        each_joint_data.append((obj.vertex_groups[group.group].name, group.weight))
-                    each_joint_data.sort(key = lambda x: x[1], reverse = True)
-
-                spm_vertex = Vertex()
-                spm_vertex.m_position = vertices
-                if export_normal:
-                    spm_vertex.m_normal = mathutils.Vector(mesh.vertices[v].normal).normalized().freeze()
-                if colors:
-                    vcolor = colors.data[li].color[:3]
-                    spm_vertex.m_color = tuple(min(int(c * 255), 255) for c in vcolor)
-                spm_vertex.m_all_uvs = all_uvs
-                if need_export_tangent:
-                    if not no_tangents:
-                        tangent = mathutils.Vector(mesh.loops[li].tangent).normalized().to_4d()
-                        tangent.w = -mesh.loops[li].bitangent_sign
-                        spm_vertex.m_tangent = tangent.freeze()
-                spm_vertex.m_bones_weights = each_joint_data
-                spm_vertices.append(spm_vertex)
-
-            triangle = Triangle()
-            assert len(spm_vertices) == 3
-            triangle.m_vertices = spm_vertices
-            triangle.m_texture_one = texture_one
-            triangle.m_texture_two = texture_two
-            triangle.m_texture_cmp = texture_cmp
-            triangle.m_armature_name = arm.data.name if arm != None else None
-            all_triangles.append(triangle)
+        min_edge, max_edge = mesh_arrays.getBoundingBox()
+        if bounding_boxes is None:
+            bounding_boxes = [*min_edge[[0, 2, 1]], *max_edge[[0, 2, 1]]]
+        else:
+            for i, axis in enumerate([0, 2, 1]):
+                bounding_boxes[i] = min(bounding_boxes[i], min_edge[axis])
+                bounding_boxes[i + 3] = max(bounding_boxes[i + 3], max_edge[axis])
+
+        used_index, triangle_material = np.unique(mesh_arrays.m_material_index,
+            return_inverse = True)
+        used_material = []
+        for material_index in used_index.tolist():
+            textures = getMaterialTextures(obj, material_index, uv_two is not None,
+                material_cache)
+            if textures not in material_ids:
+                material_ids[textures] = len(texture_pairs)
+                texture_pairs.append(textures)
+            used_material.append(material_ids[textures])
+        mesh_arrays.m_material_id = np.array(used_material, dtype = np.int64)[triangle_material]
+
+        if arm != None:
+            mesh_arrays.extractWeights(mesh, obj, arm_dict[arm.data.name].m_bone_names)
+        mesh_arrays.m_armature_name = arm.data.name if arm != None else None
+        all_meshes.append(mesh_arrays)
 
         if need_export_tangent:
             mesh.free_tangents()
+        # Only the arrays are needed from now on
+        mesh_owner.to_mesh_clear()
 
     if all_no_tangents:
         need_export_tangent = False
+    export_vcolor = spm_parameters.get("export-vcolor") and has_vertex_color
 
+    # Only the corner arrays that are written are kept
+    assert len(all_meshes) > 0
+    positions = concatenateCorners(all_meshes, "m_positions", (0.0, 0.0, 0.0), np.float32)
+    normals = concatenateCorners(all_meshes, "m_normals", (0.0, 0.0, 1.0), np.float32)\
+    if export_normal else None
+    vcolors = concatenateCorners(all_meshes, "m_colors", (255, 255, 255), np.uint8)\
+    if export_vcolor else None
+    all_uvs = concatenateCorners(all_meshes, "m_uvs", (0.0, 0.0, 0.0, 0.0), np.float64)
+    tangents = concatenateCorners(all_meshes, "m_tangents", (1.0, 0.0, 0.0, 1.0), np.float32)\
+    if need_export_tangent else None
+    for mesh_arrays in all_meshes:
+        mesh_arrays.m_normals = None
+        mesh_arrays.m_colors = None
+        mesh_arrays.m_tangents = None
+
+    joints = None
+    weights = None
     if arm_count != 0:
+        joints = np.full((len(positions), 4), -1, dtype = np.int64)
+        weights = np.zeros((len(positions), 4), dtype = np.float64)
         ExportArm.m_accumulated_bone = 0
         for arm_name in sorted(arm_dict.keys()):
-            arm_dict[arm_name].buildIndex(all_triangles)
+            arm_dict[arm_name].buildIndex(all_meshes, joints, weights)
             arm_dict[arm_name].buildLocalId()
 
-        useless_arm = True
-        for triangle in all_triangles:
-            for vertex in triangle.m_vertices:
-                total_weights = sum(vertex.m_weights)
-                if total_weights > 0.0:
-                    useless_arm = False
-                    for i in range(0, 4):
-                        vertex.m_weights[i] /= total_weights
-                vertex.m_joints = tuple(vertex.m_joints)
-                vertex.m_weights = tuple(vertex.m_weights)
-        if useless_arm:
+        if not np.any(joints[:, 0] != -1):
             arm_count = 0
-    if arm_count == 0:
-        for t in all_triangles:
-            t.removeJointsData()
-
-    assert len(all_triangles) > 0
-    all_triangles.sort(key = lambda x: x.m_texture_cmp)
-    spm_buffer = bytearray()
-
-    # SP header
-    spm_buffer += writeUint16(20563)
-
-    # 5 bit version, 3 bit type : SPMS SPMA SPMN
-    # SPMS (space partitioned split mesh not supported in python)
-    byte = 0
-    byte = spm_version << 3
-    byte |= 1 if arm_count != 0 else 2
-    spm_buffer += writeUint8(byte)
-
-    # bit 0: export-normal
-    # bit 1: export-vcolor
-    # bit 2: export-tangent
-    byte = 0
-    if export_normal:
-        byte = 1
-    export_vcolor = spm_parameters.get("export-vcolor") and has_vertex_color
-    if export_vcolor:
-        byte = 1 << 1 | byte
-    if need_export_tangent:
-        byte = 1 << 2 | byte
-    spm_buffer += writeUint8(byte)
-    for position in bounding_boxes:
-        spm_buffer += writeFloat(position)
-
-    tex_cmp = None
-    texture_list = []
-    for triangle in all_triangles:
-        if triangle.m_texture_cmp != tex_cmp:
-            tex_cmp = triangle.m_texture_cmp
-            texture_list.append(triangle.m_texture_one)
-            texture_list.append(triangle.m_texture_two)
-    material_count = len(texture_list) >> 1
-    spm_buffer += writeUint16(material_count)
-    #print(material_count)
-    for texture_name in texture_list:
-        spm_buffer += writeLenString(texture_name)
-
-    # No SPMS so always 1 sector count
-    spm_buffer += writeUint16(1)
-
-    vbo_ibo = bytearray()
-    vertices_dict = {}
-    vertices = []
-    indices = []
-    tex_cmp = all_triangles[0].m_texture_cmp
-    material_count = 0
-    mesh_buffer_count = 0
 
-    if arm_count != 0:
-        bpy.context.scene.frame_set(static_mesh_frame)
-    for t_idx in range(0, len(all_triangles) + 1):
-        cur_cmp = all_triangles[t_idx].m_texture_cmp \
-        if t_idx < len(all_triangles) else None
-        if cur_cmp != tex_cmp or len(vertices) > 65532:
-            tex_cmp = cur_cmp
-            vbo_ibo += writeUint(len(vertices))
-            vbo_ibo += writeUint(len(indices))
-            vbo_ibo += writeUint16(material_count)
-            #print(len(vertices))
-            #print(len(indices))
-            assert len(vertices) < 65536
-            for vertex in vertices:
-                vbo_ibo += vertex.writeVertex(export_normal,\
-                all_triangles[t_idx -1].m_texture_one != "",\
-                all_triangles[t_idx -1].m_texture_two != "",\
-                export_vcolor, None if arm_count == 0 else arm_dict,\
-                need_export_tangent)
-            for index in indices:
-                if len(vertices) > 255:
-                    vbo_ibo += writeUint16(index)
-                else:
-                    vbo_ibo += writeUint8(index)
-            if not len(vertices) > 65532:
-                material_count = material_count + 1
-            mesh_buffer_count += 1
-            vertices_dict = {}
-            vertices = []
-            indices = []
-        if t_idx >= len(all_triangles):
-            break
-        triangle = all_triangles[t_idx]
-        for vertex in reversed(triangle.m_vertices):
-            if vertex not in vertices_dict:
-                vertex_location = len(vertices)
-                indices.append(vertex_location)
-                vertices.append(vertex)
-                vertices_dict[vertex] = vertex_location
-            else:
-                indices.append(vertices_dict[vertex])
-
-    spm_buffer += writeUint16(mesh_buffer_count)
-    spm_buffer += vbo_ibo
+    # Materials are written sorted by texture names, the triangles are grouped
+    # by material with a counting sort (numpy uses a radix sort for stable
+    # sorting of 16 bit keys)
+    material_order = sorted(range(0, len(texture_pairs)),
+        key = lambda x: (''.join(texture_pairs[x]), texture_pairs[x]))
+    material_rank = np.empty(len(texture_pairs), dtype = np.int64)
+    material_rank[material_order] = np.arange(len(texture_pairs))
+    texture_pairs = [texture_pairs[x] for x in material_order]
+    triangle_material = material_rank[np.concatenate([m.m_material_id for m in all_meshes])]
+    triangle_order = np.argsort(triangle_material.astype(np.uint16), kind = 'stable')
+
+    # Sectors for SPMS, triangles of each sector keep the material order
+    if sector_size > 0.0 and arm_count != 0:
+        print("Skinned meshes cannot be space partitioned, exporting a single sector")
+        sector_size = 0.0
+    if sector_size > 0.0:
+        triangle_sector = partitionTriangles(positions, sector_size)
+        if triangle_sector.max() >= 65535:
+            print("Too many sectors, please use a larger sector size, exporting a single sector")
+            sector_size = 0.0
+    if sector_size > 0.0:
+        triangle_order = triangle_order[np.argsort(triangle_sector[triangle_order], kind = 'stable')]
+        sector_end = np.cumsum(np.bincount(triangle_sector))
+    else:
+        sector_end = np.array([len(triangle_order)])
 
+    palette = None
     if arm_count != 0:
-        spm_buffer += writeUint8(len(arm_dict))
-        spm_buffer += writeUint16(static_mesh_frame - 1)
-        for arm_name in sorted(arm_dict.keys()):
-            armature = arm_dict[arm_name].writeArmature()
-            if armature is not None:
-                spm_buffer += armature
-
-    spm = open(filename,'wb')
-    spm.write(spm_buffer)
-    spm.close()
+        bpy.context.scene.frame_set(static_mesh_frame)
+        palette = buildSkinningPalette(arm_dict)
+
+    # Written to a temporary file first, so that a failed export does not
+    # leave a truncated .spm behind
+    temp_filename = filename + ".tmp"
+    try:
+        with open(temp_filename, 'wb') as spm:
+            # SP header
+            spm.write(writeUint16(20563))
+
+            # 5 bit version, 3 bit type : SPMS SPMA SPMN
+            # SPMS (space partitioned mesh) only for static meshes with sector-size
+            byte = 0
+            byte = spm_version << 3
+            if arm_count != 0:
+                byte |= 1
+            elif sector_size <= 0.0:
+                byte |= 2
+            spm.write(writeUint8(byte))
+
+            # bit 0: export-normal
+            # bit 1: export-vcolor
+            # bit 2: export-tangent
+            byte = 0
+            if export_normal:
+                byte = 1
+            if export_vcolor:
+                byte = 1 << 1 | byte
+            if need_export_tangent:
+                byte = 1 << 2 | byte
+            spm.write(writeUint8(byte))
+            for position in bounding_boxes:
+                spm.write(writeFloat(position))
+
+            material_count = len(texture_pairs)
+            spm.write(writeUint16(material_count))
+            #print(material_count)
+            for texture_one, texture_two in texture_pairs:
+                spm.write(writeLenString(texture_one))
+                spm.write(writeLenString(texture_two))
+
+            spm.write(writeUint16(len(sector_end)))
+
+            buffer_writer = MeshBufferWriter(spm, positions, normals,
+                vcolors, all_uvs, tangents,
+                joints if arm_count != 0 else None, weights, palette, weld_tolerance,
+                optimize_vertex_cache)
+            sector_start = 0
+            for sector_triangle_end in sector_end.tolist():
+                sector_triangles = triangle_order[sector_start:sector_triangle_end]
+                sector_material = triangle_material[sector_triangles]
+                sector_start = sector_triangle_end
+
+                # Mesh buffer count, patched once all buffers of the sector are written
+                mesh_buffer_count_offset = spm.tell()
+                spm.write(writeUint16(0))
+                mesh_buffer_count = 0
+                for material_id, (texture_one, texture_two) in enumerate(texture_pairs):
+                    first, last = np.searchsorted(sector_material, [material_id, material_id + 1])
+                    if first == last:
+                        continue
+                    mesh_buffer_count += buffer_writer.writeMaterial(material_id,
+                        sector_triangles[first:last], texture_one != "", texture_two != "")
+
+                buffers_end = spm.tell()
+                spm.seek(mesh_buffer_count_offset)
+                spm.write(writeUint16(mesh_buffer_count))
+                spm.seek(buffers_end)
+
+                if sector_size > 0.0:
+                    # Sector bounding box, same layout as the one in the header
+                    corners = positions[(sector_triangles[:, None] * 3 + [0, 1, 2]).ravel()]
+                    min_edge = corners.min(axis = 0)
+                    max_edge = corners.max(axis = 0)
+                    for position in [*min_edge[[0, 2, 1]], *max_edge[[0, 2, 1]]]:
+                        spm.write(writeFloat(position))
+
+            if arm_count != 0:
+                spm.write(writeUint8(len(arm_dict)))
+                spm.write(writeUint16(static_mesh_frame - 1))
+                for arm_name in sorted(arm_dict.keys()):
+                    armature = arm_dict[arm_name].writeArmature()
+                    if armature is not None:
+                        spm.write(armature)
+
+        os.replace(temp_filename, filename)
+    except Exception:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+    if optimize_vertex_cache and buffer_writer.m_triangle_count > 0:
+        print("Vertex cache ACMR: {:.3f} before, {:.3f} after optimization".format(
+            buffer_writer.m_cache_misses_before / buffer_writer.m_triangle_count,
+            buffer_writer.m_cache_misses_after / buffer_writer.m_triangle_count))
 
     end = time.time()
-    print("Exported in", (end - start))
\ No newline at end of file
+    print("Exported in", (end - start))
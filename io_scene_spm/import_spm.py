@@ -267,8 +267,8 @@ def loadSPM(context, filepath, extra_tex_path):
     sector_count = struct.unpack('<H', spm.read(2))[0]
 
     for sector in range(0, sector_count):
-        material_count = struct.unpack('<H', spm.read(2))[0]
-        for material in range(0, material_count):
+        mesh_buffer_count = struct.unpack('<H', spm.read(2))[0]
+        for mesh_buffer in range(0, mesh_buffer_count):
             vertices_count = struct.unpack('<I', spm.read(4))[0]
             indices_count = struct.unpack('<i', spm.read(4))[0]
             material_id = struct.unpack('<H', spm.read(2))[0]